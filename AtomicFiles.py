@@ -0,0 +1,41 @@
+'''
+Atomic file writes shared by the caches, stores and exports: the new content goes to a temporary
+file next to the target, which is moved over it only once complete, so a reader, another thread or
+a process killed mid-write never leaves or sees a partial file.
+
+    save_atomic("labels.npy", lambda f: np.save(f, labels))
+
+    with atomic_path("slices.npy") as tmp_path:   # for writers that need a path
+        np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=shape)
+
+'''
+
+import os
+import threading
+import contextlib
+
+def temporary_path(path):
+    """Temporary name next to path, unique per process and thread so concurrent writers do not collide."""
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+@contextlib.contextmanager
+def atomic_path(path):
+    """
+    Yield a temporary path that replaces path when the block completes.
+    The temporary file is removed when the block raises, path is left untouched.
+    """
+    tmp_path = temporary_path(path)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def save_atomic(path, write):
+    """Write path with write(f), f being the temporary file opened in binary mode. Returns path."""
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, "wb") as f:
+            write(f)
+    return path
@@ -0,0 +1,278 @@
+'''
+Offline evaluation of the lumbar checkpoints on the validation split of a slice store (see TrainingData).
+
+Each backbone runs once over the validation slices and its penultimate-layer features are cached
+to disk (./eval_cache, git ignored) together with the weights of its classification head. Accuracy,
+weighted log-loss and confusion matrices per level and per condition are then computed with NumPy
+from the cached features against data/train_cleaned.csv, so scoring another head, temperature or
+decision threshold takes seconds instead of a CNN pass over every slice.
+
+The validation studies should be the held-out ones of the checkpoints, given with --split, see
+split_description. Without it a random split of the store is used and the report says so under "split":
+
+    python Evaluation.py ./slice_store --cnn alex res --split held_out.csv --output report.json
+    python Evaluation.py ./slice_store --cnn alex --views saggital2 --split held_out.csv --head ./models/new_head.pth --thresholds 0.4 0.2
+
+'''
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+
+import numpy as np
+import torch
+
+from InteractiveModels import CNN_MODELS, VIEWS, Levels, model_device, registry, resolve_model_key
+from AtomicFiles import save_atomic
+from LabelStore import LabelStore, Severities
+from StudyInference import VIEW_CONDITIONS, read_study_ids, slices_to_tensor
+from TrainingData import SliceStore
+
+# Sample weights of the true severity in the RSNA 2024 lumbar spine metric
+SEVERITY_WEIGHTS = np.array([1.0, 2.0, 4.0])
+
+def head_layer(model):
+    """Final Linear layer of a CustomAlexNet or CustomResNet, its input is the penultimate feature vector."""
+    return model.model.classifier[-1] if hasattr(model.model, "classifier") else model.model.fc
+
+def extract_features(model, slices, positions, batch_size=64):
+    """Penultimate features, (slices, features) float32, of the store slices at positions."""
+    head = head_layer(model)
+    device = model_device(model)
+    captured = []
+    hook = head.register_forward_hook(lambda module, inputs, output: captured.append(inputs[0].detach().cpu()))
+    try:
+        with torch.no_grad():
+            for start in range(0, len(positions), batch_size):
+                batch = np.asarray(slices[positions[start:start + batch_size]])
+                model(slices_to_tensor(list(batch)).to(device))
+    finally:
+        hook.remove()
+    if not captured:
+        return np.zeros((0, head.in_features), dtype=np.float32)
+    return torch.cat(captured).numpy().astype(np.float32, copy=False)
+
+def split_description(split_path=None, source=None, **sampling):
+    """
+    Studies a report is computed on, kept in the report under "split".
+
+    The checkpoints were trained on 80% of data/train_cleaned.csv and the training notebooks do not
+    keep the studies they trained on, so only a split file (see StudyInference.read_study_ids) tells
+    the held-out studies apart. With split_path those studies are returned; otherwise the studies are
+    sampled by the caller, described by source and the sampling parameters, and the description
+    warns that they overlap the training data.
+    """
+    if split_path:
+        return {"source": os.path.abspath(split_path), "held_out": True, "studies": read_study_ids(split_path)}
+    return dict(
+        {"source": source, "held_out": False},
+        **sampling,
+        warning="the studies overlap the training split of the checkpoints, the metrics are optimistic",
+    )
+
+def validation_split(split_path=None, val_fraction=0.2, seed=42):
+    """Validation studies of split_path, or a random split by study of the store, see split_description."""
+    return split_description(split_path, "random split of the store", val_fraction=val_fraction, seed=seed)
+
+def validation_positions(store, view, split):
+    """Sorted store positions of the validation slices of a view."""
+    if split["held_out"]:
+        return store.select(view, studies=split["studies"])
+    return np.sort(store.split(store.select(view), split["val_fraction"], split["seed"])[1])
+
+def feature_cache_paths(cache_dir, cnn, view, store, split):
+    """Cache files of a (checkpoint, store, split), any change of them gives new files."""
+    stat = os.stat(CNN_MODELS[cnn][1][view])
+    split_key = split["studies"] if split["held_out"] else [split["val_fraction"], split["seed"]]
+    key = json.dumps([stat.st_size, stat.st_mtime_ns, store.meta["created"], store.meta["slices"], split_key])
+    base = os.path.join(cache_dir, f"{cnn}.{view}.{hashlib.blake2b(key.encode(), digest_size=8).hexdigest()}")
+    return f"{base}.features.npy", f"{base}.meta.npz"
+
+def cached_features(store_dir, cnn, view, cache_dir="./eval_cache", val_fraction=0.2, seed=42, batch_size=64, split_path=None):
+    """
+    Features of the validation slices of a view, running the backbone only when they are not cached.
+    The validation slices are the ones of the studies of split_path, see validation_split.
+
+    Returns:
+        numpy.array: (slices, features) float32, memory mapped
+        numpy.array: study id of every slice
+        numpy.array: (levels * classes, features) weight of the checkpoint head
+        numpy.array: (levels * classes,) bias of the checkpoint head
+    """
+    cnn, view = resolve_model_key(cnn, view)
+    store = SliceStore(store_dir)
+    split = validation_split(split_path, val_fraction, seed)
+    features_path, meta_path = feature_cache_paths(cache_dir, cnn, view, store, split)
+    if not os.path.exists(meta_path):
+        positions = validation_positions(store, view, split)
+        model = registry.get(cnn, view)
+        features = extract_features(model, store.slices, positions, batch_size)
+        head = head_layer(model)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        save_atomic(features_path, lambda f: np.save(f, features))
+        # The metadata goes last, its presence marks the features as complete
+        save_atomic(meta_path, lambda f: np.savez(
+            f,
+            study_ids=store.index["study_id"][positions],
+            positions=positions,
+            weight=head.weight.detach().cpu().numpy(),
+            bias=head.bias.detach().cpu().numpy(),
+        ))
+
+    meta = np.load(meta_path)
+    return np.load(features_path, mmap_mode="r"), meta["study_ids"], meta["weight"], meta["bias"]
+
+def load_head(path):
+    """(weight, bias) of a head from a .npz with weight and bias, or from a CustomAlexNet / CustomResNet checkpoint."""
+    if path.endswith(".npz"):
+        head = np.load(path)
+        return head["weight"], head["bias"]
+    state = torch.load(path, map_location="cpu")
+    for prefix in ("model.classifier.6", "model.fc"):
+        if f"{prefix}.weight" in state:
+            return state[f"{prefix}.weight"].numpy(), state[f"{prefix}.bias"].numpy()
+    raise ValueError(f"{path} has no CustomAlexNet or CustomResNet head")
+
+def head_logits(features, weight, bias):
+    """(slices, levels, classes) logits of a linear head applied to cached features."""
+    return (np.asarray(features, dtype=np.float32) @ weight.T.astype(np.float32) + bias).reshape(len(features), len(Levels), len(bias) // len(Levels))
+
+def head_probabilities(features, weight, bias, temperature=1.0):
+    """(slices, levels, classes) softmax of a linear head applied to cached features."""
+    logits = head_logits(features, weight, bias) / temperature
+    logits -= logits.max(axis=2, keepdims=True)
+    probabilities = np.exp(logits)
+    return probabilities / probabilities.sum(axis=2, keepdims=True)
+
+def aggregate_studies(probabilities, study_ids):
+    """Mean distribution of the slices of each study, returns (study ids, (studies, levels, classes))."""
+    studies, inverse = np.unique(study_ids, return_inverse=True)
+    sums = np.zeros((len(studies),) + probabilities.shape[1:])
+    np.add.at(sums, inverse, probabilities)
+    return studies, sums / np.bincount(inverse, minlength=len(studies))[:, None, None]
+
+def predict_classes(probabilities, thresholds=None):
+    """
+    Severity predicted from (..., classes) probabilities: the argmax, or with thresholds=(moderate, severe)
+    Severe when its probability reaches severe, else Moderate when Moderate or worse reaches moderate.
+    """
+    if thresholds is None:
+        return probabilities.argmax(axis=-1)
+    moderate, severe = thresholds
+    return np.where(probabilities[..., 2] >= severe, 2, np.where(probabilities[..., 1:].sum(axis=-1) >= moderate, 1, 0))
+
+def weighted_log_loss(probabilities, labels, eps=1e-15):
+    """Log-loss with every sample weighted by SEVERITY_WEIGHTS of its label, missing labels (-1) are skipped."""
+    known = labels >= 0
+    if not known.any():
+        return None
+    labels = labels[known].astype(int)
+    chosen = np.clip(probabilities[known][np.arange(len(labels)), labels], eps, 1.0)
+    weights = SEVERITY_WEIGHTS[labels]
+    return float(-(weights * np.log(chosen)).sum() / weights.sum())
+
+def confusion_matrix(labels, predicted, classes=len(Severities)):
+    """(true, predicted) counts of the known labels."""
+    known = labels >= 0
+    return np.bincount(labels[known].astype(int) * classes + predicted[known], minlength=classes * classes).reshape(classes, classes)
+
+def metrics(probabilities, labels, thresholds=None):
+    """Accuracy, weighted log-loss and confusion matrix of (samples, ..., classes) probabilities against (samples, ...) labels."""
+    predicted = predict_classes(probabilities, thresholds)
+    confusion = confusion_matrix(labels, predicted)
+    known = int(confusion.sum())
+    return {
+        "samples": known,
+        "accuracy": float(np.trace(confusion) / known) if known else None,
+        "weighted_log_loss": weighted_log_loss(probabilities, labels),
+        "confusion": confusion.tolist(),
+    }
+
+def condition_metrics(probabilities, labels, thresholds=None):
+    """Metrics of one condition over all levels and per level, labels are (samples, levels)."""
+    result = metrics(probabilities, labels, thresholds)
+    result["levels"] = {
+        level: metrics(probabilities[:, level_idx], labels[:, level_idx], thresholds)
+        for level_idx, level in enumerate(Levels)
+    }
+    return result
+
+def evaluate(store_dir, cnns=("alex", "res"), views=VIEWS, labels_path="./data/train_cleaned.csv", cache_dir="./eval_cache",
+             unit="study", head=None, temperature=1.0, thresholds=None, val_fraction=0.2, seed=42, split_path=None):
+    """
+    Metrics of every (cnn, view) on the validation split of a slice store.
+
+    Args:
+        unit (string): study scores the mean distribution of the slices of each study, slice every slice
+        head (string): optional head to score instead of the checkpoint's, see load_head
+        temperature (float): divides the logits before the softmax
+        thresholds (tuple): optional (moderate, severe) decision thresholds, see predict_classes
+        split_path (string): held-out studies of the checkpoints, a random split overlapping the
+            training data when None, see validation_split
+
+    Returns:
+        dict: {'split': description of the validation split,
+               cnn: {view: {conditions: {condition: metrics with per level metrics}}, 'overall': metrics}}
+    """
+    if unit not in ("study", "slice"):
+        raise ValueError(f"{unit} evaluation unit is not valid")
+    labels = LabelStore.load(labels_path)
+    split = validation_split(split_path, val_fraction, seed)
+    if split["held_out"]:
+        split["studies"] = len(split["studies"])
+    report = {"split": split}
+    for cnn in cnns:
+        cnn_report = report.setdefault(resolve_model_key(cnn, "saggital1")[0], {})
+        pooled_probabilities, pooled_labels = [], []
+        for view in views:
+            features, study_ids, weight, bias = cached_features(store_dir, cnn, view, cache_dir, val_fraction, seed,
+                                                                split_path=split_path)
+            if head is not None:
+                weight, bias = load_head(head)
+            probabilities = head_probabilities(features, weight, bias, temperature)
+            if unit == "study":
+                study_ids, probabilities = aggregate_studies(probabilities, study_ids)
+            known = np.isin(study_ids, labels.study_ids)
+            study_ids, probabilities = study_ids[known], probabilities[known]
+            view_labels = labels.lookup(study_ids, conditions=VIEW_CONDITIONS[view])
+            conditions = {}
+            for condition_idx, condition in enumerate(VIEW_CONDITIONS[view]):
+                conditions[condition] = condition_metrics(probabilities, view_labels[:, :, condition_idx], thresholds)
+                pooled_probabilities.append(probabilities)
+                pooled_labels.append(view_labels[:, :, condition_idx])
+            cnn_report[view] = {"slices": len(features), "samples": len(probabilities), "conditions": conditions}
+        if pooled_probabilities:
+            cnn_report["overall"] = metrics(np.concatenate(pooled_probabilities), np.concatenate(pooled_labels), thresholds)
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score the lumbar checkpoints from cached validation features")
+    parser.add_argument("store_dir", help="slice store built with TrainingData.py build")
+    parser.add_argument("--cnn", nargs="+", default=["alex", "res"], choices=["alex", "res"])
+    parser.add_argument("--views", nargs="+", default=VIEWS, choices=VIEWS)
+    parser.add_argument("--labels", default="./data/train_cleaned.csv")
+    parser.add_argument("--cache-dir", default="./eval_cache", help="where the features are kept")
+    parser.add_argument("--unit", default="study", choices=["study", "slice"])
+    parser.add_argument("--head", help="head to score instead of the checkpoint's, .pth or .npz with weight and bias")
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--thresholds", nargs=2, type=float, metavar=("MODERATE", "SEVERE"))
+    parser.add_argument("--split", help="held-out study ids the checkpoints were not trained on, CSV with study_id or one per line")
+    parser.add_argument("--val-fraction", type=float, default=0.2, help="random split used without --split")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="JSON report, printed when omitted")
+    args = parser.parse_args(argv)
+
+    report = evaluate(args.store_dir, args.cnn, args.views, args.labels, args.cache_dir, args.unit, args.head,
+                      args.temperature, args.thresholds, args.val_fraction, args.seed, args.split)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text, file=sys.stdout)
+
+if __name__ == "__main__":
+    main()
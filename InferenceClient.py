@@ -0,0 +1,118 @@
+'''
+Client side of the local inference service (see InferenceServer), kept apart from the server so
+that a GUI using it never imports torch: the models run in the service and only the saliency
+overlay is drawn here, over the pixels decoded without the model preprocessing.
+
+    client = InferenceClient("/tmp/lumbar.sock")
+    predictions, overlayed_image = client.process_image("alex", "saggital1", "./Images/x.dcm")
+
+'''
+
+import os
+import json
+import base64
+import socket
+import threading
+
+import numpy as np
+
+from InteractiveModels import load_dicom_raw_image, overlay_saliency_on_image
+
+def encode_saliency(saliency_map):
+    saliency_map = np.ascontiguousarray(saliency_map, dtype=np.float32)
+    return {"shape": list(saliency_map.shape), "data": base64.b64encode(saliency_map.tobytes()).decode("ascii")}
+
+def decode_saliency(payload):
+    data = np.frombuffer(base64.b64decode(payload["data"]), dtype=np.float32)
+    return data.reshape(payload["shape"])
+
+class InferenceClient:
+    """
+    Blocking client of the inference service, one connection per client. A connection the
+    service dropped is opened again and the request sent once more, requests only read files
+    so repeating one is harmless.
+
+    Args:
+        address (string): Unix socket path, or host:port for TCP
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self._socket = None
+        self._file = None
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if ":" in self.address and not os.path.exists(self.address):
+            host, port = self.address.rsplit(":", 1)
+            connection = socket.create_connection((host, int(port)))
+        else:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                connection.connect(self.address)
+            except OSError:
+                connection.close()
+                raise
+        self._file = connection.makefile("rwb")
+        self._socket = connection
+
+    def _disconnect(self):
+        for handle in (self._file, self._socket):
+            if handle is not None:
+                try:
+                    handle.close()
+                except OSError:
+                    pass
+        self._file = None
+        self._socket = None
+
+    def _exchange(self, line):
+        if self._socket is None:
+            self._connect()
+        self._file.write(line)
+        self._file.flush()
+        response = self._file.readline()
+        if not response:
+            raise ConnectionResetError("the inference service closed the connection")
+        return response
+
+    def request(self, payload):
+        with self._lock:
+            self._next_id += 1
+            line = json.dumps(dict(payload, id=self._next_id)).encode() + b"\n"
+            try:
+                response = self._exchange(line)
+            except OSError:
+                self._disconnect()
+                try:
+                    response = self._exchange(line)
+                except OSError as error:
+                    self._disconnect()
+                    raise ConnectionError(f"inference service at {self.address} is not reachable: {error}") from error
+            response = json.loads(response)
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response
+
+    def predict(self, path, cnn="alex", view="saggital1", saliency=False):
+        """Returns (predictions, saliency map or None)."""
+        response = self.request({"path": os.path.abspath(path), "cnn": cnn, "view": view, "saliency": saliency})
+        saliency_map = decode_saliency(response["saliency"]) if "saliency" in response else None
+        return response["predictions"], saliency_map
+
+    def process_image(self, cnn, model, image_path):
+        """
+        Same result as InteractiveModels.process_image, with the inference done by the service.
+        The overlay is drawn over the cached uint8 pixels, the same decode the GUI shows, the
+        model input is never built in this process.
+        """
+        predictions, saliency_map = self.predict(image_path, cnn, model, saliency=True)
+        return predictions, overlay_saliency_on_image(saliency_map, load_dicom_raw_image(image_path))
+
+    def stats(self):
+        return self.request({"stats": True})["stats"]
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
@@ -0,0 +1,228 @@
+'''
+Local inference service shared by every Streamlit session.
+
+Requests are newline delimited JSON over a Unix socket (or TCP), they are grouped per model into
+micro-batches bounded by a maximum size and a maximum wait and run on the warm models of the registry:
+
+    python InferenceServer.py --socket /tmp/lumbar.sock --max-batch-size 16 --max-wait 0.01
+
+    request:  {"id": 1, "path": "./Images/x.dcm", "cnn": "alex", "view": "saggital1", "saliency": true}
+    response: {"id": 1, "predictions": {...}, "saliency": {"shape": [224, 224], "data": "<base64 float32>"}}
+
+The client, InferenceClient, lives in its own module so that the GUI does not import torch.
+
+'''
+
+import os
+import json
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from InferenceClient import InferenceClient, encode_saliency
+from InteractiveModels import (
+    dicom_cache,
+    outputs_to_predictions,
+    predict_with_saliency,
+    registry,
+    resolve_model_key,
+    stack_inputs,
+)
+
+def run_batch(cnn, view, paths, saliency):
+    """
+    Predictions for a micro-batch of the same model, one forward for the images without saliency
+    and one forward and backward for the ones that asked for it.
+    Returns one (predictions, saliency map or None) per path, or the exception raised decoding it.
+    """
+    model = registry.get(cnn, view)
+    results = [None] * len(paths)
+    images = {}
+    for i, path in enumerate(paths):
+        try:
+            images[i] = dicom_cache.tensor(path)
+        except Exception as error:
+            results[i] = error
+    plain = [i for i in images if not saliency[i]]
+    with_saliency = [i for i in images if saliency[i]]
+    if plain:
+        batch = stack_inputs([images[i] for i in plain]).to(registry.device)
+        with torch.no_grad():
+            outputs = model(batch)
+        for i, predictions in zip(plain, outputs_to_predictions(outputs.cpu())):
+            results[i] = (predictions, None)
+    if with_saliency:
+        batch = stack_inputs([images[i] for i in with_saliency])
+        predictions, maps = predict_with_saliency(model, batch, registry.device)
+        for i, image_predictions, saliency_map in zip(with_saliency, predictions, maps):
+            results[i] = (image_predictions, saliency_map)
+    return results
+
+class MicroBatcher:
+    """
+    Groups concurrent requests for the same (cnn, view) into batches.
+
+    A batch is sent to the model when it reaches max_batch_size or max_wait seconds after its
+    first request arrived. Batches run one at a time on a single thread, the model itself uses
+    the torch intra-op threads.
+    """
+
+    def __init__(self, max_batch_size=16, max_wait=0.01):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._queues = {}
+        self._workers = {}
+        self.batches = 0
+        self.requests = 0
+
+    async def submit(self, path, cnn, view, saliency=False):
+        """Predict one image, returns (predictions, saliency map or None)."""
+        key = resolve_model_key(cnn, view)
+        if key not in self._queues:
+            self._queues[key] = asyncio.Queue()
+            self._workers[key] = asyncio.create_task(self._worker(key))
+        future = asyncio.get_running_loop().create_future()
+        await self._queues[key].put((path, saliency, future))
+        return await future
+
+    async def _worker(self, key):
+        loop = asyncio.get_running_loop()
+        queue = self._queues[key]
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            paths = [path for path, _, _ in batch]
+            saliency = [wants for _, wants, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, run_batch, *key, paths, saliency)
+            except Exception as error:
+                results = [error] * len(batch)
+            self.batches += 1
+            self.requests += len(batch)
+            for (_, _, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "models": registry.stats(),
+        }
+
+    async def close(self):
+        for worker in self._workers.values():
+            worker.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        self.executor.shutdown()
+
+async def handle_request(batcher, request):
+    if request.get("stats"):
+        return {"id": request.get("id"), "stats": batcher.stats()}
+    try:
+        predictions, saliency_map = await batcher.submit(
+            request["path"], request.get("cnn", "alex"), request.get("view", "saggital1"), request.get("saliency", False)
+        )
+    except Exception as error:
+        return {"id": request.get("id"), "error": f"{type(error).__name__}: {error}"}
+    response = {"id": request.get("id"), "predictions": predictions}
+    if saliency_map is not None:
+        response["saliency"] = encode_saliency(saliency_map)
+    return response
+
+async def handle_connection(batcher, reader, writer):
+    """Serve the requests of a connection concurrently, responses are written as they finish."""
+    lock = asyncio.Lock()
+    tasks = set()
+
+    async def answer(line):
+        try:
+            response = await handle_request(batcher, json.loads(line))
+        except json.JSONDecodeError as error:
+            response = {"error": f"invalid request: {error}"}
+        async with lock:
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+
+    try:
+        while line := await reader.readline():
+            if line.strip():
+                task = asyncio.create_task(answer(line))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+    finally:
+        writer.close()
+
+async def serve(socket_path=None, host="127.0.0.1", port=8765, max_batch_size=16, max_wait=0.01, preload=()):
+    batcher = MicroBatcher(max_batch_size, max_wait)
+    registry.preload(preload)
+
+    async def on_connection(reader, writer):
+        await handle_connection(batcher, reader, writer)
+
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = await asyncio.start_unix_server(on_connection, path=socket_path, limit=2 ** 24)
+    else:
+        server = await asyncio.start_server(on_connection, host, port, limit=2 ** 24)
+    async with server:
+        await server.serve_forever()
+
+class InProcessClient(InferenceClient):
+    """
+    Client with the same interface as InferenceClient that runs a MicroBatcher on an event loop
+    thread of this process instead of talking to a socket, for tests and single process setups.
+    """
+
+    def __init__(self, max_batch_size=16, max_wait=0.01):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self.batcher = MicroBatcher(max_batch_size, max_wait)
+
+    def request(self, payload):
+        future = asyncio.run_coroutine_threadsafe(handle_request(self.batcher, payload), self._loop)
+        response = json.loads(json.dumps(future.result()))
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.batcher.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local inference service with dynamic request batching")
+    parser.add_argument("--socket", help="Unix socket path, TCP on --host/--port when omitted")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--max-wait", type=float, default=0.01, help="seconds a batch waits for more requests")
+    parser.add_argument("--preload", nargs="*", default=[], metavar="CNN:VIEW", help="models loaded at startup")
+    args = parser.parse_args(argv)
+
+    preload = [tuple(key.split(":", 1)) for key in args.preload]
+    asyncio.run(serve(args.socket, args.host, args.port, args.max_batch_size, args.max_wait, preload))
+
+if __name__ == "__main__":
+    main()
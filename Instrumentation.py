@@ -0,0 +1,215 @@
+'''
+Opt-in per stage timing and memory instrumentation of the prediction pipeline.
+
+Disabled by default, where every hook is a shared no-op context. Enable it from the environment:
+
+    INSTRUMENTATION=ring                      keep the last records in memory
+    INSTRUMENTATION=log                       write each record to the "lumbar.instrumentation" logger
+    INSTRUMENTATION=prometheus:/path/file.prom  Prometheus text format, rewritten every few seconds
+
+or from code with instrumentation.enable(RingBufferSink(1000)).
+
+'''
+
+import os
+import time
+import logging
+import threading
+import contextlib
+from collections import deque, OrderedDict
+
+from AtomicFiles import save_atomic
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+def process_rss_bytes():
+    """Resident memory of the process, read from /proc on Linux, None elsewhere."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def tensor_memory_bytes():
+    """Memory held by tensors: the CUDA allocator when a GPU is in use, the process RSS otherwise."""
+    import sys
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        return torch.cuda.memory_allocated()
+    return process_rss_bytes()
+
+class RingBufferSink:
+    """Keeps the last maxlen records in memory."""
+
+    def __init__(self, maxlen=1000):
+        self.records = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def record(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def requests(self, n=10):
+        """Records of the last n requests, newest first: [{'request', 'name', 'stages': [...]}]."""
+        with self._lock:
+            records = list(self.records)
+        grouped = OrderedDict()
+        for record in reversed(records):
+            request = record["request"]
+            if request not in grouped:
+                if len(grouped) == n:
+                    break
+                grouped[request] = {"request": request, "name": record["request_name"], "stages": []}
+            grouped[request]["stages"].insert(0, record)
+        return list(grouped.values())
+
+class LogSink:
+    """Writes one log line per record."""
+
+    def __init__(self, logger="lumbar.instrumentation", level=logging.INFO):
+        self.logger = logging.getLogger(logger) if isinstance(logger, str) else logger
+        self.level = level
+
+    def record(self, record):
+        self.logger.log(
+            self.level,
+            "request=%s stage=%s wall=%.4fs cpu=%.4fs memory_delta=%s",
+            record["request"], record["stage"], record["wall"], record["cpu"], record["memory_delta"],
+        )
+
+class PrometheusTextSink:
+    """
+    Aggregates the records per stage and rewrites a Prometheus text format file, for the
+    node exporter textfile collector, at most every interval seconds.
+    """
+
+    def __init__(self, path, interval=5.0):
+        self.path = path
+        self.interval = interval
+        self.totals = {}
+        self._last_write = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, record):
+        with self._lock:
+            count, wall, cpu = self.totals.get(record["stage"], (0, 0.0, 0.0))
+            self.totals[record["stage"]] = (count + 1, wall + record["wall"], cpu + record["cpu"])
+            if time.monotonic() - self._last_write >= self.interval:
+                self.flush()
+
+    def flush(self):
+        lines = [
+            "# HELP lumbar_stage_calls_total Calls of each pipeline stage.",
+            "# TYPE lumbar_stage_calls_total counter",
+        ]
+        lines += [f'lumbar_stage_calls_total{{stage="{stage}"}} {count}' for stage, (count, _, _) in self.totals.items()]
+        lines += [
+            "# HELP lumbar_stage_wall_seconds_total Wall time spent in each pipeline stage.",
+            "# TYPE lumbar_stage_wall_seconds_total counter",
+        ]
+        lines += [f'lumbar_stage_wall_seconds_total{{stage="{stage}"}} {wall}' for stage, (_, wall, _) in self.totals.items()]
+        lines += [
+            "# HELP lumbar_stage_cpu_seconds_total CPU time of the calling thread in each pipeline stage.",
+            "# TYPE lumbar_stage_cpu_seconds_total counter",
+        ]
+        lines += [f'lumbar_stage_cpu_seconds_total{{stage="{stage}"}} {cpu}' for stage, (_, _, cpu) in self.totals.items()]
+        save_atomic(self.path, lambda f: f.write(("\n".join(lines) + "\n").encode()))
+        self._last_write = time.monotonic()
+
+class _Stage:
+    __slots__ = ("instrumentation", "name", "wall", "cpu", "memory")
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.memory = tensor_memory_bytes()
+        self.cpu = time.thread_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        memory = tensor_memory_bytes()
+        memory_delta = memory - self.memory if memory is not None and self.memory is not None else None
+        self.instrumentation._emit(self.name, wall, cpu, memory_delta)
+        return False
+
+class Instrumentation:
+    """
+    Records wall time, CPU time of the calling thread and tensor memory change of named stages.
+
+    Stages run inside a request share its id, so a sink can show a whole process_image call.
+    When disabled, request() and stage() return the same no-op context and record nothing.
+    """
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.enabled = sink is not None
+        self._local = threading.local()
+        self._next_request = 0
+        self._lock = threading.Lock()
+
+    def enable(self, sink):
+        self.sink = sink
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return _Stage(self, name)
+
+    @contextlib.contextmanager
+    def _request(self, name):
+        if getattr(self._local, "request", None) is not None:
+            # Nested requests, like predict_image inside process_image, belong to the outer one
+            with self.stage(name):
+                yield
+            return
+        with self._lock:
+            self._next_request += 1
+            self._local.request = self._next_request
+        self._local.request_name = name
+        try:
+            with self.stage(name):
+                yield
+        finally:
+            self._local.request = None
+
+    def request(self, name):
+        """Context grouping the stages of one prediction, itself recorded as a stage."""
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._request(name)
+
+    def _emit(self, stage, wall, cpu, memory_delta):
+        self.sink.record({
+            "request": getattr(self._local, "request", None),
+            "request_name": getattr(self._local, "request_name", None),
+            "stage": stage,
+            "wall": wall,
+            "cpu": cpu,
+            "memory_delta": memory_delta,
+            "timestamp": time.time(),
+        })
+
+def sink_from_env(value):
+    """Sink described by the INSTRUMENTATION environment variable, None when it is unset."""
+    if not value:
+        return None
+    kind, _, argument = value.partition(":")
+    if kind == "ring":
+        return RingBufferSink(int(argument) if argument else 1000)
+    if kind == "log":
+        return LogSink()
+    if kind == "prometheus":
+        return PrometheusTextSink(argument or "lumbar.prom")
+    raise ValueError(f"{value} instrumentation sink is not valid")
+
+# Shared instrumentation used by the hooks of InteractiveModels
+instrumentation = Instrumentation(sink_from_env(os.environ.get("INSTRUMENTATION")))
@@ -3,15 +3,36 @@ Python module that loads and handles the prediction and saliency map from the se
 
 '''
 
-import torch
-import torch.nn as nn
-import torchvision.models as models
-from torchvision import transforms
+import importlib
 import numpy as np
-import matplotlib.pyplot as plt
-from PIL import Image
-import pydicom
 from PIL import Image
+import threading
+import time
+import os
+import io
+import hashlib
+from collections import OrderedDict, namedtuple
+from AtomicFiles import save_atomic
+from Instrumentation import instrumentation
+
+class _LazyModule:
+    """Stand-in for a module that is imported on its first attribute access."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+# torch, torchvision and pydicom take seconds to import, they are only loaded once they are used
+torch = _LazyModule("torch")
+nn = _LazyModule("torch.nn")
+F = _LazyModule("torch.nn.functional")
+transforms = _LazyModule("torchvision.transforms")
+pydicom = _LazyModule("pydicom")
 
 AlexNetModel = {
     "saggital1": "./models/alexnet_saggitalt1_model.pth",
@@ -25,53 +46,366 @@ ResNetModel = {
     "saggital2": "./models/resnet_sagittal_t2.pth"
 }
 
-class CustomAlexNet(nn.Module):
-    def __init__(self, num_levels=5, num_classes=3):
-        self.num_levels = num_levels
-        self.num_classes = num_classes
-        super(CustomAlexNet, self).__init__()
-        self.model = models.alexnet(weights=None)  # Load AlexNet
-        num_ftrs = self.model.classifier[-1].in_features
-        self.model.classifier[-1] = nn.Linear(num_ftrs, num_levels * num_classes)  # Modify to output all levels
-
-    def forward(self, x):
-        x = self.model(x)
-        return x.view(-1, self.num_levels, self.num_classes)  # Reshape to (batch, levels, classes
-
-class CustomResNet(nn.Module):
-    def __init__(self, num_levels=5, num_classes=3):
-        self.num_levels = num_levels
-        self.num_classes = num_classes
-        super(CustomResNet, self).__init__()
-        self.model = models.resnet18(weights=None)  # Load ResNet-18; you could use resnet50 or other versions as well
-        num_ftrs = self.model.fc.in_features
-        self.model.fc = nn.Linear(num_ftrs, num_levels * num_classes)  # Modify the output layer for all levels
-
-    def forward(self, x):
-        x = self.model(x)
-        return x.view(-1, self.num_levels, self.num_classes)  # Reshape to (batch, levels, classe
-
-# Image Transformer
-transform = transforms.Compose([
-    transforms.ToPILImage(),
-    transforms.Resize((224, 224)),
-    transforms.Grayscale(num_output_channels=3),
-    transforms.ToTensor(),
-])
-
-def load_model(model_type, view_type):
-    model_path = None
-    if model_type == "alexnet":
-        model_path = AlexNetModel[view_type]
-        model = CustomAlexNet()
-    elif model_type == "resnet":
-        model_path = ResNetModel[view_type]
-        model = CustomResNet()
-
-    model.load_state_dict(torch.load(model_path))
+_transform = None
+
+def get_transform():
+    """Image Transformer, built on first use."""
+    global _transform
+    if _transform is None:
+        _transform = transforms.Compose([
+            transforms.ToPILImage(),
+            transforms.Resize((224, 224)),
+            transforms.Grayscale(num_output_channels=3),
+            transforms.ToTensor(),
+        ])
+    return _transform
+
+IMAGE_SIZE = (224, 224)
+
+# ITU-R 601-2 luma weights, the same PIL uses to convert RGB images to grayscale
+LUMA_WEIGHTS = (0.299, 0.587, 0.114)
+
+def tensor_transform(images, size=IMAGE_SIZE):
+    """
+    Tensor only equivalent of transform for a batch of images.
+
+    Resizing runs with torch's antialiased bilinear interpolation on the whole batch and the
+    three channels are an expanded view of the grayscale one instead of copies.
+    The output matches transform within 1/255 per pixel, one uint8 level coming from the
+    rounding of PIL's fixed point resampling.
+
+    Args:
+        images (list or torch.Tensor): uint8 arrays of shape (height, width) or (height, width, 3),
+            or a uint8 tensor of shape (batch, height, width)
+        size (tuple): output height and width
+
+    Returns:
+        torch.Tensor: (batch, 3, height, width) float tensor in [0, 1]
+    """
+    if isinstance(images, torch.Tensor):
+        groups = [images]
+    else:
+        # Images with the same shape are stacked and resized together
+        groups = []
+        for image in images:
+            image = torch.as_tensor(np.asarray(image))
+            if image.ndim == 3:
+                image = (image.float() * torch.tensor(LUMA_WEIGHTS)).sum(dim=-1).round()
+            if groups and groups[-1][-1].shape == image.shape:
+                groups[-1].append(image)
+            else:
+                groups.append([image])
+        groups = [torch.stack(group) for group in groups]
+
+    resized = []
+    for batch in groups:
+        batch = batch.unsqueeze(1).float()
+        batch = F.interpolate(batch, size=size, mode="bilinear", align_corners=False, antialias=True)
+        resized.append(batch.round_().clamp_(0, 255))
+    batch = torch.cat(resized) if len(resized) > 1 else resized[0]
+    batch = batch.div_(255.0)
+    return batch.expand(-1, 3, -1, -1)
+
+def pil_transform(images):
+    """Batch version of the PIL based transform."""
+    transform = get_transform()
+    return torch.stack([transform(image) for image in images])
+
+def numpy_transform(images, size=IMAGE_SIZE):
+    """
+    NumPy equivalent of transform for a batch of images, used by the ONNX backend so that it
+    never imports torch. Resizing and the grayscale conversion run through PIL in the same
+    order as transform, so the values are the same.
+
+    Returns:
+        numpy.array: (batch, 3, height, width) float32 array in [0, 1], the channels are a broadcast view
+    """
+    batch = np.empty((len(images), 1) + tuple(size), dtype=np.float32)
+    for i, image in enumerate(images):
+        image = Image.fromarray(np.asarray(image)).resize(tuple(size)[::-1], Image.BILINEAR)
+        batch[i, 0] = np.asarray(image.convert("L"))
+    batch /= 255.0
+    return np.broadcast_to(batch, (len(images), 3) + tuple(size))
+
+# Preprocessing backends selectable from load_dicom_image and predict_images,
+# numpy gives NumPy arrays for the ONNX backend, the others torch tensors
+PREPROCESS_BACKENDS = {
+    "pil": pil_transform,
+    "tensor": tensor_transform,
+    "numpy": numpy_transform,
+}
+
+def preprocess(images, backend="pil"):
+    if backend not in PREPROCESS_BACKENDS:
+        raise ValueError(f"{backend} preprocessing backend is not valid")
+    return PREPROCESS_BACKENDS[backend](images)
+
+# Accepted cnn names, both the short ones used by process_image and the long ones used by load_model
+CNN_ALIASES = {
+    "alex": "alexnet",
+    "alexnet": "alexnet",
+    "res": "resnet",
+    "resnet": "resnet",
+}
+
+# Network class names, defined in Networks, and checkpoint paths of every cnn
+CNN_MODELS = {
+    "alexnet": ("CustomAlexNet", AlexNetModel),
+    "resnet": ("CustomResNet", ResNetModel),
+}
+
+# Views with a model for every cnn. The slice store index keeps positions in this list,
+# so new views go at the end
+VIEWS = ["saggital1", "axial", "saggital2"]
+
+def model_class(cnn):
+    """Network class of a cnn, importing torch and torchvision on the first call."""
+    import Networks
+    return getattr(Networks, CNN_MODELS[resolve_model_key(cnn, "saggital1")[0]][0])
+
+def resolve_model_key(cnn, view):
+    """Normalize a (cnn, view) pair into the registry key, raising ValueError if any is not valid."""
+    if cnn not in CNN_ALIASES:
+        raise ValueError(f"{cnn} cnn is not valid")
+    cnn = CNN_ALIASES[cnn]
+    if view not in CNN_MODELS[cnn][1]:
+        raise ValueError(f"{view} model is not valid")
+    return cnn, view
+
+_default_device = None
+
+def default_device():
+    """cuda if available, checked once per process."""
+    global _default_device
+    if _default_device is None:
+        _default_device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    return _default_device
+
+# Inference variants of every checkpoint:
+#   fp32: the eager model loaded from the .pth file
+#   int8: Linear layers dynamically quantized to int8, CPU only
+#   torchscript: traced and frozen TorchScript module
+#   onnx: ONNX export run by ONNX Runtime's CPU execution provider, see OnnxBackend
+MODEL_BACKENDS = ["fp32", "int8", "torchscript", "onnx"]
+
+def backend_artifact_path(model_path, backend, device="cpu"):
+    """Path of the converted model kept next to its .pth checkpoint."""
+    base, _ = os.path.splitext(model_path)
+    if backend == "onnx":
+        return f"{base}.onnx"
+    device_type = torch.device(device).type
+    suffix = backend if device_type == "cpu" else f"{backend}.{device_type}"
+    return f"{base}.{suffix}.pt"
+
+def is_numpy_model(model):
+    """Whether a model takes and returns NumPy arrays, like the ONNX Runtime ones, instead of tensors."""
+    return getattr(model, "numpy_io", False)
+
+def backend_device(backend, device):
+    # Dynamically quantized kernels and the ONNX Runtime session only run on the CPU
+    return torch.device("cpu") if backend in ("int8", "onnx") else torch.device(device)
+
+def build_model(cnn, view, device="cpu", backend="fp32"):
+    """
+    Construct the network for (cnn, view), load its checkpoint and leave it in eval mode on device.
+
+    For the int8 and torchscript backends the converted model is cached next to the .pth file
+    and reused while it is newer than the checkpoint, so the conversion only runs once.
+    """
+    cnn, view = resolve_model_key(cnn, view)
+    if backend not in MODEL_BACKENDS:
+        raise ValueError(f"{backend} backend is not valid")
+    if backend == "onnx":
+        from OnnxBackend import load_onnx_model
+        return load_onnx_model(cnn, view, int(os.environ.get("ONNX_INTRA_OP_THREADS", 0)))
+    paths = CNN_MODELS[cnn][1]
+    device = backend_device(backend, device)
+
+    artifact = backend_artifact_path(paths[view], backend, device)
+    cached = backend != "fp32" and os.path.exists(artifact) and os.path.getmtime(artifact) >= os.path.getmtime(paths[view])
+    if backend == "torchscript" and cached:
+        return torch.jit.load(artifact, map_location=device).eval()
+
+    model = model_class(cnn)()
+    if backend == "int8":
+        model.eval()
+        if cached:
+            model = quantize_linear(model)
+            with instrumentation.stage("torch.load"):
+                model.load_state_dict(torch.load(artifact))
+            return model
+        with instrumentation.stage("torch.load"):
+            model.load_state_dict(torch.load(paths[view], map_location=device))
+        model = quantize_linear(model)
+        torch.save(model.state_dict(), artifact)
+        return model
+
+    with instrumentation.stage("torch.load"):
+        model.load_state_dict(torch.load(paths[view], map_location=device))
+    model.to(device)
     model.eval()  # Set the model to evaluation mode
+    if backend == "torchscript":
+        example = torch.zeros(1, 3, *IMAGE_SIZE, device=device)
+        with torch.no_grad():
+            model = torch.jit.freeze(torch.jit.trace(model, example))
+        torch.jit.save(model, artifact)
     return model
 
+def quantize_linear(model):
+    """Dynamically quantize the Linear layers, where most of the AlexNet weights are, to int8."""
+    from torch.ao.quantization import quantize_dynamic
+    return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+def model_size_bytes(model):
+    """Memory taken by the parameters and buffers of a model."""
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+def model_footprint(cnn, view, backend, model, device="cpu"):
+    """
+    Memory estimate used by the registry budget. Quantized and frozen models keep their
+    weights outside of parameters(), for them the size of the converted artifact is used.
+    """
+    if backend == "onnx":
+        return os.path.getsize(model.path)
+    if backend == "fp32":
+        return model_size_bytes(model)
+    artifact = backend_artifact_path(CNN_MODELS[cnn][1][view], backend, backend_device(backend, device))
+    return os.path.getsize(artifact) if os.path.exists(artifact) else model_size_bytes(model)
+
+def model_device(model):
+    """Device of a model, frozen TorchScript modules and ONNX models have no parameters and are taken as CPU."""
+    if isinstance(model, (nn.Module, torch.jit.ScriptModule)):
+        for tensor in model.parameters():
+            return tensor.device
+    return torch.device("cpu")
+
+class ModelRegistry:
+    """
+    Process wide cache of loaded models keyed by (cnn, view, backend).
+
+    Models are loaded lazily on the first request, kept resident on the device in eval mode
+    and evicted in least recently used order once the memory budget is exceeded.
+
+    Args:
+        device (torch.device): device where the models are kept, defaults to cuda if available
+            (resolved on first use so creating a registry does not import torch)
+        max_bytes (int): memory budget for the resident models, None means unbounded
+    """
+
+    def __init__(self, device=None, max_bytes=None):
+        self._device = device
+        self.max_bytes = max_bytes
+        self._models = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_time = 0.0
+
+    @property
+    def device(self):
+        if self._device is None:
+            self._device = default_device()
+        elif not isinstance(self._device, torch.device):
+            self._device = torch.device(self._device)
+        return self._device
+
+    def get(self, cnn, view, backend="fp32"):
+        """Return the warm model for (cnn, view, backend), loading it if it is not resident."""
+        key = resolve_model_key(cnn, view) + (backend,)
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self.hits += 1
+                self._models.move_to_end(key)
+                return model
+            self.misses += 1
+            start = time.perf_counter()
+            # ONNX models always run on the CPU, resolving the device would import torch
+            device = "cpu" if backend == "onnx" else self.device
+            model = build_model(*key[:2], device=device, backend=backend)
+            self.load_time += time.perf_counter() - start
+            self._models[key] = model
+            self._sizes[key] = model_footprint(*key, model, device)
+            self._evict(keep=key)
+            return model
+
+    def preload(self, keys=None, backend="fp32"):
+        """
+        Load the given (cnn, view) or (cnn, view, backend) keys ahead of time,
+        all the known models when keys is None.
+        """
+        if keys is None:
+            keys = [(cnn, view) for cnn, (_, paths) in CNN_MODELS.items() for view in paths]
+        return [self.get(*key) if len(key) == 3 else self.get(*key, backend=backend) for key in keys]
+
+    def warm_up(self, keys=None, backend="fp32"):
+        """
+        Preload the given models and run one dummy forward through each, so the first real
+        request does not pay for imports, checkpoint loading or the first kernel calls.
+        """
+        blank = [np.zeros((256, 256), dtype=np.uint8)]
+        models = self.preload(keys, backend)
+        for model in models:
+            if is_numpy_model(model):
+                model.run(numpy_transform(blank))
+                continue
+            example = stack_inputs(preprocess(blank, dicom_cache.backend))
+            with torch.no_grad():
+                model(example.to(model_device(model)))
+        return models
+
+    def _evict(self, keep):
+        if self.max_bytes is None:
+            return
+        while self.resident_bytes() > self.max_bytes and len(self._models) > 1:
+            key = next(iter(self._models))
+            if key == keep:
+                break
+            del self._models[key]
+            del self._sizes[key]
+            self.evictions += 1
+
+    def resident_bytes(self):
+        return sum(self._sizes.values())
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+            self._sizes.clear()
+
+    def stats(self):
+        """Counters to check the cache is doing its job."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "load_time": self.load_time,
+                "resident": list(self._models.keys()),
+                "resident_bytes": self.resident_bytes(),
+            }
+
+# Shared registry used by load_model and process_image
+registry = ModelRegistry()
+
+def warm_up(keys=None, backend="fp32", background=True):
+    """
+    Warm the shared registry, in a daemon thread when background is True so a server or the
+    GUI can start answering meanwhile. Returns the thread, or the warm models when run in place.
+    """
+    if not background:
+        return registry.warm_up(keys, backend)
+    thread = threading.Thread(target=registry.warm_up, args=(keys, backend), name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+def load_model(model_type, view_type, backend="fp32"):
+    """Warm model from the shared registry, backend is one of MODEL_BACKENDS."""
+    return registry.get(model_type, view_type, backend)
+
 def preprocess_image(image_path):
     preprocess = transforms.Compose([
         transforms.Resize(256),
@@ -92,111 +426,495 @@ def predict_diagnosis(image_path, model_type, view_type):
         output = model(image_tensor)
     return output
 
-def load_dicom_image(dicom_path):
-    """Load and preprocess a DICOM image."""
-    dicom = pydicom.dcmread(dicom_path)
+def dicom_to_uint8(dicom):
+    """Pixel data of a read DICOM dataset scaled to a 2D or 3D uint8 array."""
     image = dicom.pixel_array
 
-    # Normalize image to 0-255 if needed
+    # Normalize to 0-255 if necessary and convert to uint8
     if np.max(image) > 255:
         image = (image / np.max(image)) * 255.0
-    
-    image = image.astype(np.uint8)  # Convert to uint8 for PIL compatibility
-    image = transform(image)  # Apply transformations
-    image = image.unsqueeze(0)  # Add batch dimension
+    image = image.astype(np.uint8)
+
+    # Ensure the image is 2D or 3D by removing any extra dimensions
+    if image.ndim == 4 and image.shape[0] == 1:
+        image = np.squeeze(image, axis=0)
+    elif image.ndim == 4 and image.shape[-1] == 1:
+        image = np.squeeze(image, axis=-1)
+
     return image
 
-def predict_image(model, dicom_path, device):
-    """Get predictions for each level from a DICOM image."""
-    model.eval()  # Set model to evaluation mode
-    Levels = ["L1/L2","L2/L3","L3/L4","L4/L5","L5/S1"]
-    Classes = ["Normal/Mid","Moderate","Severe"]
-    image = load_dicom_image(dicom_path).to(device)  # Load and move to device
+def dicom_to_display(dicom):
+    """Pixel data of a read DICOM dataset with the modality LUT applied, stretched to uint8 for display."""
+    from pydicom.pixel_data_handlers.util import apply_modality_lut
+    image = apply_modality_lut(dicom.pixel_array, dicom)
+    image = (image - image.min()) / (image.max() - image.min()) * 255.0
+    return image.astype(np.uint8)
+
+def content_hash(data):
+    """Hash identifying the contents of a DICOM file."""
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+def file_content_hash(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    return content_hash(data), data
+
+# Everything decoded from one DICOM file:
+#   raw: uint8 pixel array used for the saliency overlay
+#   tensor: (3, 224, 224) model input after transform, None until a model first asks for it
+#   display: uint8 image with the modality LUT applied, shown in the GUI
+DicomEntry = namedtuple("DicomEntry", ["raw", "tensor", "display"])
+
+class DicomCache:
+    """
+    Content addressed cache of decoded DICOM files.
 
-    with torch.no_grad():
-        outputs = model(image)  # Forward pass
+    Entries are keyed by the hash of the file bytes, so the same image uploaded twice or read
+    from two paths is decoded only once. A memory tier keeps the most recently used entries
+    within max_bytes, an optional disk tier stores them as .npy files that are memory mapped back.
+    The model input is only built by tensor(), so showing an image never runs the transform.
+
+    Args:
+        max_bytes (int): memory budget for the in-memory tier
+        disk_dir (string): directory for the on-disk tier, None disables it
+        backend (string): preprocessing backend used to build the cached tensors
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024, disk_dir=None, backend="pil"):
+        if backend not in PREPROCESS_BACKENDS:
+            raise ValueError(f"{backend} preprocessing backend is not valid")
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.backend = backend
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._hashes = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, dicom_path):
+        """Content hash of a file, remembered per path while its size and mtime do not change."""
+        stat = os.stat(dicom_path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        cached = self._hashes.get(dicom_path)
+        if cached is not None and cached[0] == signature:
+            return cached[1], None
+        digest, data = file_content_hash(dicom_path)
+        self._hashes[dicom_path] = (signature, digest)
+        return digest, data
+
+    def get(self, dicom_path):
+        """Return the DicomEntry of a file, decoding it only if no tier has it."""
+        digest, data = self.key(dicom_path)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                self.hits += 1
+                self._entries.move_to_end(digest)
+                return entry
+
+        entry = self._load_disk(digest)
+        if entry is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            if data is None:
+                with open(dicom_path, "rb") as f:
+                    data = f.read()
+            entry = self.decode(data)
+            self._save_disk(digest, entry)
+
+        with self._lock:
+            self._entries[digest] = entry
+            self._sizes[digest] = entry_bytes(entry)
+            self._entries.move_to_end(digest)
+            while sum(self._sizes.values()) > self.max_bytes and len(self._entries) > 1:
+                oldest = next(iter(self._entries))
+                del self._entries[oldest]
+                del self._sizes[oldest]
+        return entry
+
+    def decode(self, data):
+        with instrumentation.stage("dcmread"):
+            dicom = pydicom.dcmread(io.BytesIO(data))
+            raw = dicom_to_uint8(dicom)
+            display = dicom_to_display(dicom)
+        return DicomEntry(raw, None, display)
+
+    def raw(self, dicom_path):
+        return self.get(dicom_path).raw
+
+    def tensor(self, dicom_path, backend=None):
+        """
+        Model input of a file, built from the cached pixels the first time and kept with the entry.
+        Another backend than the cache's is built from the pixels on every call.
+        """
+        entry = self.get(dicom_path)
+        if backend is not None and backend != self.backend:
+            return preprocess([entry.raw], backend)[0]
+        if entry.tensor is None:
+            with instrumentation.stage("transform"):
+                entry = entry._replace(tensor=preprocess([entry.raw], self.backend)[0])
+            digest = self.key(dicom_path)[0]
+            self._save_disk(digest, entry, fields=["tensor"])
+            with self._lock:
+                if digest in self._entries:
+                    self._entries[digest] = entry
+                    self._sizes[digest] = entry_bytes(entry)
+        return entry.tensor
+
+    def display(self, dicom_path):
+        return self.get(dicom_path).display
+
+    def _disk_paths(self, digest):
+        names = {field: f"{digest}.{field}.npy" for field in DicomEntry._fields}
+        names["tensor"] = f"{digest}.tensor.{self.backend}.npy"
+        return {field: os.path.join(self.disk_dir, name) for field, name in names.items()}
+
+    def _load_disk(self, digest):
+        if self.disk_dir is None:
+            return None
+        paths = self._disk_paths(digest)
+        if not (os.path.exists(paths["raw"]) and os.path.exists(paths["display"])):
+            return None
+        # Copy on write maps keep the arrays lazy while still giving writable tensors
+        arrays = {
+            field: np.asarray(np.load(path, mmap_mode="c")) if os.path.exists(path) else None
+            for field, path in paths.items()
+        }
+        if arrays["tensor"] is not None and self.backend != "numpy":
+            arrays["tensor"] = torch.from_numpy(arrays["tensor"])
+        return DicomEntry(**arrays)
+
+    def _save_disk(self, digest, entry, fields=DicomEntry._fields):
+        if self.disk_dir is None:
+            return
+        os.makedirs(self.disk_dir, exist_ok=True)
+        paths = self._disk_paths(digest)
+        for field in fields:
+            path = paths[field]
+            value = getattr(entry, field)
+            if value is None:
+                continue
+            if not isinstance(value, np.ndarray):
+                value = value.numpy()
+            save_atomic(path, lambda f: np.save(f, value))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "resident_bytes": sum(self._sizes.values()),
+            }
+
+def entry_bytes(entry):
+    return sum(value.nbytes for value in entry if value is not None)
+
+# Shared cache used by load_dicom_image, load_dicom_raw_image and the GUI, set DICOM_CACHE_DIR to keep it on disk
+dicom_cache = DicomCache(
+    disk_dir=os.environ.get("DICOM_CACHE_DIR"),
+    backend=os.environ.get("PREPROCESS_BACKEND", "pil"),
+)
+
+def stack_inputs(images, backend=None):
+    """
+    Batch of preprocessed images: a NumPy array for the numpy backend, a tensor otherwise,
+    converting the NumPy inputs of a cache built with the numpy backend.
+    """
+    if backend == "numpy":
+        return np.stack([np.asarray(image) for image in images])
+    if isinstance(images, np.ndarray):
+        return torch.from_numpy(np.array(images))
+    return torch.stack([torch.from_numpy(np.array(image)) if isinstance(image, np.ndarray) else image for image in images])
+
+def load_dicom_image(dicom_path, backend=None):
+    """Load and preprocess a DICOM image, backend is one of PREPROCESS_BACKENDS (defaults to the cache's)."""
+    with instrumentation.stage("load_dicom_image"):
+        image = dicom_cache.tensor(dicom_path, backend)
+    return stack_inputs([image], backend)  # Add batch dimension
+
+Levels = ["L1/L2","L2/L3","L3/L4","L4/L5","L5/S1"]
+Classes = ["Normal/Mid","Moderate","Severe"]
+
+def outputs_to_predictions(outputs):
+    """
+    Turn a batch of (batch, levels, classes) logits into one predictions dict per image.
+    Softmax and argmax run once over the whole batch and the results are moved to python in a single call.
+    NumPy logits, as the ONNX models give, are handled without torch.
+    """
+    if isinstance(outputs, np.ndarray):
+        exponentials = np.exp(outputs - outputs.max(axis=2, keepdims=True))
+        probabilities = exponentials / exponentials.sum(axis=2, keepdims=True)
+    else:
         probabilities = torch.softmax(outputs, dim=2)  # Apply softmax along classes dimension
+    return probabilities_to_predictions(probabilities)
 
-        predictions = {}
-        for level_idx, level_probs in enumerate(probabilities.squeeze(0)):
-            class_idx = torch.argmax(level_probs).item()
-            confidence = level_probs[class_idx].item()
-            predictions[Levels[level_idx]] = {
-                'Class': Classes[class_idx],
-                'Confidence': confidence
+def probabilities_to_predictions(probabilities):
+    """Same predictions dicts from already computed (batch, levels, classes) probabilities."""
+    if isinstance(probabilities, np.ndarray):
+        confidences, class_idx = probabilities.max(axis=2), probabilities.argmax(axis=2)
+    else:
+        confidences, class_idx = probabilities.max(dim=2)
+    confidences = confidences.tolist()
+    class_idx = class_idx.tolist()
+    return [
+        {
+            Levels[level_idx]: {
+                'Class': Classes[image_classes[level_idx]],
+                'Confidence': image_confidences[level_idx]
             }
+            for level_idx in range(len(image_classes))
+        }
+        for image_classes, image_confidences in zip(class_idx, confidences)
+    ]
+
+def predict_image(model, dicom_path, device):
+    """Get predictions for each level from a DICOM image."""
+    with instrumentation.request("predict_image"):
+        if is_numpy_model(model):
+            # ONNX Runtime models: NumPy preprocessing and outputs, torch is never imported
+            with instrumentation.stage("forward"):
+                outputs = model.run(load_dicom_image(dicom_path, "numpy"))
+            return outputs_to_predictions(outputs)[0]
+        model.eval()  # Set model to evaluation mode
+        image = load_dicom_image(dicom_path).to(device)  # Load and move to device
+
+        with torch.no_grad(), instrumentation.stage("forward"):
+            outputs = model(image)  # Forward pass
+
+        return outputs_to_predictions(outputs)[0]
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def load_dicom_images(paths, backend=None):
+    """Load and preprocess several DICOM images into one (batch, 3, 224, 224) tensor, or array for the numpy backend."""
+    if backend is None or backend == dicom_cache.backend:
+        return stack_inputs([dicom_cache.tensor(path) for path in paths], backend)
+    # Preprocess the whole batch at once from the cached pixels
+    return preprocess([dicom_cache.raw(path) for path in paths], backend)
+
+def predict_images(model, paths, batch_size=16, device=None, backend=None):
+    """
+    Get predictions for many DICOM images, running one forward pass per batch.
 
+    Args:
+        model (nn.Module): loaded CustomAlexNet or CustomResNet
+        paths (iterable): paths to the .dcm files
+        batch_size (int): number of images stacked in each forward pass
+        device (torch.device): defaults to the device where the model lives
+        backend (string): preprocessing backend, "pil" or "tensor", ONNX models always use "numpy"
+
+    Returns:
+        list: one predictions dict per path, in the same format and order as predict_image
+    """
+    if is_numpy_model(model):
+        return [
+            prediction
+            for batch_paths in iter_batches(paths, batch_size)
+            for prediction in outputs_to_predictions(model.run(load_dicom_images(batch_paths, "numpy")))
+        ]
+    model.eval()
+    if device is None:
+        device = model_device(model)
+    predictions = []
+    for batch_paths in iter_batches(paths, batch_size):
+        images = load_dicom_images(batch_paths, backend).to(device)
+        with torch.no_grad():
+            outputs = model(images)
+        predictions.extend(outputs_to_predictions(outputs))
     return predictions
 
 def load_dicom_raw_image(dicom_path):
-    dicom = pydicom.dcmread(dicom_path)
-    image = dicom.pixel_array
+    return dicom_cache.raw(dicom_path)
 
-    # Normalize to 0-255 if necessary and convert to uint8
-    if np.max(image) > 255:
-        image = (image / np.max(image)) * 255.0
-    image = image.astype(np.uint8)
+def saliency_from_outputs(outputs, input_images, method="vjp"):
+    """
+    Computes the combined saliency maps for all levels from an already computed forward pass.
 
-    # Ensure the image is 2D or 3D by removing any extra dimensions
-    if image.ndim == 4 and image.shape[0] == 1:
-        image = np.squeeze(image, axis=0)
-    elif image.ndim == 4 and image.shape[-1] == 1:
-        image = np.squeeze(image, axis=-1)
-    
-    return image
+    Args:
+        outputs (torch.Tensor): (batch, levels, classes) logits still attached to the graph of input_images
+        input_images (torch.Tensor): (batch, channels, height, width) tensor that required grad in the forward
+        method (string): how the gradients of the predicted classes are obtained:
+            vjp: one batched vector-Jacobian product giving the gradient of every level,
+                 the maps accumulate the absolute gradient of each level
+            sum: one backward of the sum of the selected logits, cheaper but levels
+                 with opposite gradients cancel each other
 
-def compute_saliency_map(model, input_image, device):
-    """
-    Computes a combined saliency map for all levels in a multi-level model.
+    Returns:
+        torch.Tensor: (batch, height, width) saliency maps normalized to [0, 1] per image
     """
-    model.eval()
-    input_image = input_image.to(device)
-    input_image.requires_grad_()
+    # Score of the predicted class for every image and level, shape (batch, levels)
+    target_class = outputs.argmax(dim=2, keepdim=True)
+    scores = outputs.gather(2, target_class).squeeze(2)
+    num_levels = scores.shape[1]
+
+    if method == "vjp":
+        # One one-hot cotangent per level, all of them propagated in the same backward
+        cotangents = torch.eye(num_levels, dtype=scores.dtype, device=scores.device)
+        cotangents = cotangents.unsqueeze(1).expand(num_levels, scores.shape[0], num_levels)
+        gradients, = torch.autograd.grad(scores, input_images, grad_outputs=cotangents, is_grads_batched=True)
+        saliency_maps = gradients[:, :, 0].abs().sum(dim=0)
+    elif method == "sum":
+        gradients, = torch.autograd.grad(scores.sum(), input_images)
+        saliency_maps = gradients[:, 0].abs()
+    else:
+        raise ValueError(f"{method} saliency method is not valid")
 
-    # Forward pass
-    outputs = model(input_image)  # Shape should be (batch, levels, classes)
+    saliency_maps = saliency_maps / num_levels  # Average across levels for combined saliency
 
-    # Initialize saliency map with the same shape as input but reduced to one channel
-    saliency_map = torch.zeros(input_image.shape[2:], device=device)
+    # Normalize each saliency map
+    flat = saliency_maps.flatten(1)
+    minimum = flat.min(dim=1).values.view(-1, 1, 1)
+    maximum = flat.max(dim=1).values.view(-1, 1, 1)
+    return (saliency_maps - minimum) / (maximum - minimum).clamp_min(1e-12)
 
-    Levels = ["L1/L2", "L2/L3", "L3/L4", "L4/L5", "L5/S1"]
+def predict_with_saliency(model, input_images, device, method="vjp"):
+    """
+    Predictions and saliency maps for a batch of preprocessed images using a single forward
+    and a single backward pass.
 
-    for level_idx in range(outputs.shape[1]):
-        # Get the predicted class for this level
-        level_output = outputs[0, level_idx]  # Get output for the current level
-        target_class = level_output.argmax().item()  # Use the predicted class for saliency
+    Returns:
+        list: one predictions dict per image, same format as predict_image
+        numpy.array: (batch, height, width) saliency maps
+    """
+    model.eval()
+    input_images = input_images.to(device).detach().requires_grad_()
 
-        # Get the score for the target class
-        score = level_output[target_class]
-        
-        # Zero out previous gradients
-        model.zero_grad()
-        
-        # Backpropagate to get the gradient of the target score w.r.t. the input image
-        score.backward(retain_graph=True)
+    with torch.enable_grad():
+        with instrumentation.stage("forward"):
+            outputs = model(input_images)  # Shape should be (batch, levels, classes)
+        with instrumentation.stage("saliency"):
+            saliency_maps = saliency_from_outputs(outputs, input_images, method)
 
-        # Accumulate the gradients for each level into the saliency map
-        saliency_map += input_image.grad.data.abs()[0, 0] * 0.2  # Accumulate across levels for combined saliency
+    predictions = outputs_to_predictions(outputs.detach())
+    return predictions, saliency_maps.detach().cpu().numpy()
 
-    # Normalize saliency map
-    saliency_map = (saliency_map - saliency_map.min()) / (saliency_map.max() - saliency_map.min())
-    return saliency_map.cpu().numpy()
+def compute_saliency_maps(model, input_images, device, method="vjp"):
+    """Computes the combined saliency map of every image in a (batch, channels, height, width) tensor."""
+    return predict_with_saliency(model, input_images, device, method)[1]
 
-def overlay_saliency_on_image(saliency_map, original_image):
-    # Resize saliency map to match the original image size (if necessary)
-    if saliency_map.shape != original_image.shape:
-        saliency_map = np.interp(saliency_map, (saliency_map.min(), saliency_map.max()), (0, 1))
-        saliency_map = np.array(Image.fromarray((saliency_map * 255).astype(np.uint8)).resize(original_image.shape[::-1]))
+def compute_saliency_map(model, input_image, device):
+    """
+    Computes a combined saliency map for all levels in a multi-level model.
+    """
+    with instrumentation.request("compute_saliency_map"):
+        return compute_saliency_maps(model, input_image, device)[0]
+
+def colormap_lut(name):
+    """(256, 3) float32 table mapping a uint8 saliency value to an RGB color in [0, 1]."""
+    x = np.linspace(0, 1, 256, dtype=np.float32)
+    zeros = np.zeros_like(x)
+    if name == "red":
+        channels = [x, zeros, zeros]
+    elif name == "hot":
+        channels = [np.clip(3 * x, 0, 1), np.clip(3 * x - 1, 0, 1), np.clip(3 * x - 2, 0, 1)]
+    elif name == "jet":
+        channels = [np.clip(1.5 - np.abs(4 * x - c), 0, 1) for c in (3, 2, 1)]
+    elif name == "gray":
+        channels = [x, x, x]
+    else:
+        raise ValueError(f"{name} colormap is not valid")
+    return np.stack(channels, axis=1)
+
+COLORMAP_LUTS = {name: colormap_lut(name) for name in ["red", "hot", "jet", "gray"]}
+
+def _render_overlay_batch(saliency_maps, original_images, alpha, lut):
+    """Blend a (batch, h, w) stack of saliency maps over a (batch, H, W) stack of images."""
+    batch, height, width = original_images.shape
+    if saliency_maps.shape[1:] != (height, width):
+        # Stretch each map to [0, 255] and resize it to the image with PIL, as uint8
+        saliency_maps = saliency_maps.astype(np.float64)
+        minimum = saliency_maps.min(axis=(1, 2), keepdims=True)
+        span = saliency_maps.max(axis=(1, 2), keepdims=True) - minimum
+        scaled = ((saliency_maps - minimum) / np.where(span > 0, span, 1) * 255).astype(np.uint8)
+        index = np.empty((batch, height, width), dtype=np.uint8)
+        for i in range(batch):
+            index[i] = np.asarray(Image.fromarray(scaled[i]).resize((width, height), Image.BICUBIC))
+        # The resized map is blended on its 0-255 scale, as it always has been
+        colors = lut * np.float32(alpha * 255)
+    else:
+        index = np.rint(np.clip(saliency_maps, 0, 1) * 255).astype(np.uint8)
+        colors = lut * np.float32(alpha)
 
+    blended = np.empty((batch, height, width, 3), dtype=np.float32)
+    gray = blended[..., 0]
     # Normalize original image for better contrast in overlay
-    original_image = (original_image - original_image.min()) / (original_image.max() - original_image.min())
+    minimum = original_images.min(axis=(1, 2), keepdims=True).astype(np.float32)
+    span = original_images.max(axis=(1, 2), keepdims=True).astype(np.float32) - minimum
+    np.subtract(original_images, minimum, out=gray, dtype=np.float32)
+    gray /= np.where(span > 0, span, 1)
+    blended[..., 1] = gray
+    blended[..., 2] = gray
+
+    # Add the colormap of the saliency, skipping the channels the colormap leaves at zero
+    for channel in range(3):
+        if colors[:, channel].any():
+            blended[..., channel] += colors[:, channel][index]
+    return blended
+
+def render_overlays(saliency_maps, original_images, alpha=0.01, colormap="red"):
+    """
+    Blend saliency maps over their grayscale images for a whole batch in one call.
+
+    Works in float32 with in-place operations and a precomputed colormap table instead of
+    full size float64 temporaries. With the defaults the result has the same shape and range
+    as the original overlay: the normalized image in the three channels plus alpha times the
+    saliency in red, on the 0-255 scale when the map had to be resized to the image.
+
+    Args:
+        saliency_maps (numpy.array or list): (height, width) maps in [0, 1]
+        original_images (numpy.array or list): 2D uint8 images the maps are drawn over
+        alpha (float): weight of the saliency colors
+        colormap (string): red, hot, jet or gray
 
-    # Overlay: set saliency map as red and blend with original grayscale image
-    overlay = np.stack([saliency_map, np.zeros_like(saliency_map), np.zeros_like(saliency_map)], axis=-1)
-    blended = np.stack([original_image] * 3, axis=-1) + 0.01 * overlay
-    
+    Returns:
+        numpy.array: (batch, height, width, 3) float32 when every image has the same shape,
+        otherwise a list of (height, width, 3) arrays
+    """
+    if colormap not in COLORMAP_LUTS:
+        raise ValueError(f"{colormap} colormap is not valid")
+    lut = COLORMAP_LUTS[colormap]
+    original_images = [np.asarray(image) for image in original_images]
+    saliency_maps = [np.asarray(saliency_map, dtype=np.float32) for saliency_map in saliency_maps]
+
+    # Images and maps of the same shapes are rendered together
+    groups = {}
+    for i, (saliency_map, image) in enumerate(zip(saliency_maps, original_images)):
+        groups.setdefault((saliency_map.shape, image.shape), []).append(i)
+    if len(groups) == 1:
+        return _render_overlay_batch(np.stack(saliency_maps), np.stack(original_images), alpha, lut)
+
+    blended = [None] * len(original_images)
+    for indexes in groups.values():
+        rendered = _render_overlay_batch(
+            np.stack([saliency_maps[i] for i in indexes]), np.stack([original_images[i] for i in indexes]), alpha, lut
+        )
+        for i, image in zip(indexes, rendered):
+            blended[i] = image
     return blended
 
+def overlay_saliency_on_image(saliency_map, original_image, alpha=0.01, colormap="red"):
+    """Blend one saliency map over its image, see render_overlays."""
+    return render_overlays([saliency_map], [original_image], alpha, colormap)[0]
+
 def process_image(cnn,model,image_path):
     """_summary_
 
@@ -225,35 +943,27 @@ def process_image(cnn,model,image_path):
         , 
         numpy.array  : NumPy array with the information of the image with the saliency map
     """
-    Model = None
-    dic = None
-    if cnn == "res":
-        #ResNet predictions
-        Model = CustomResNet()
-        dic = ResNetModel
-    elif cnn == "alex":
-        #AlexNet predictions
-        Model = CustomAlexNet()
-        dic = AlexNetModel
-    else:
-        raise ValueError(f"{cnn} cnn is not valid")
-    if model not in dic.keys():
-        raise ValueError(f"{model} model is not valid")
-    Model.load_state_dict(torch.load(dic[model]))
-    # Set the model to evaluation mode (important for inference)
-    Model.eval()
-    # Move to GPU if available
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    Model.to(device)
-    predictions = predict_image(Model, image_path,device)
-    #get the classes predictions from the image
-    
-    # Get the saliency map
-    raw_image = load_dicom_raw_image(image_path)
-    input_image = transform(raw_image).unsqueeze(0)  # Add batch dimension
-
-    # Generate saliency map
-    saliency_map = compute_saliency_map(Model, input_image, device)
-    overlayed_image = overlay_saliency_on_image(saliency_map, raw_image)
-    
+    with instrumentation.request("process_image"):
+        # Warm model from the shared registry, already in eval mode on its device
+        with instrumentation.stage("load_model"):
+            Model = registry.get(cnn, model)
+        device = registry.device
+        raw_image = load_dicom_raw_image(image_path)
+        input_image = load_dicom_image(image_path)
+
+        # Get the classes predictions and the saliency map from the same forward pass
+        predictions, saliency_maps = predict_with_saliency(Model, input_image, device)
+        predictions, saliency_map = predictions[0], saliency_maps[0]
+        with instrumentation.stage("overlay"):
+            overlayed_image = overlay_saliency_on_image(saliency_map, raw_image)
+
     return predictions ,overlayed_image
+
+def __getattr__(name):
+    # Names that need torch are made on first access, e.g. "from InteractiveModels import CustomAlexNet"
+    if name == "transform":
+        return get_transform()
+    if name in ("CustomAlexNet", "CustomResNet"):
+        import Networks
+        return getattr(Networks, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
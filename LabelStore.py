@@ -0,0 +1,162 @@
+'''
+Compact store of the study labels of data/train.csv (or its float encoded data/train_cleaned.csv).
+
+The 25 condition columns are converted once into an int8 (studies, levels, conditions) array with
+-1 for missing labels and cached as .npy files in a cache folder next to the CSV (data/cache, git
+ignored), later loads memory map the cache instead of parsing the CSV:
+
+    labels = LabelStore.load("./data/train.csv")
+    labels.lookup([4003253, 4646740], conditions=["spinal_canal_stenosis"])  # (2, 5, 1) int8
+    labels.class_frequencies()  # (levels, conditions, severities) counts
+
+'''
+
+import os
+import json
+
+import numpy as np
+
+from AtomicFiles import save_atomic
+from InteractiveModels import Levels
+
+# Severity names as written in data/train.csv, in the order of the model classes
+Severities = ["Normal/Mild", "Moderate", "Severe"]
+
+# Condition column order of data/train.csv
+CONDITIONS = [
+    "spinal_canal_stenosis",
+    "left_neural_foraminal_narrowing",
+    "right_neural_foraminal_narrowing",
+    "left_subarticular_stenosis",
+    "right_subarticular_stenosis",
+]
+
+LEVEL_SUFFIXES = [level.lower().replace("/", "_") for level in Levels]
+
+CONDITION_COLUMNS = [f"{condition}_{level}" for condition in CONDITIONS for level in LEVEL_SUFFIXES]
+
+MISSING = -1
+
+def encode_labels(frame):
+    """
+    int8 (studies, levels, conditions) array of a train.csv like frame, with either the severity
+    names or their float codes, missing values become MISSING.
+    """
+    values = frame[CONDITION_COLUMNS].to_numpy()
+    codes = np.full(values.shape, MISSING, dtype=np.int8)
+    if values.dtype == object:
+        for code, severity in enumerate(Severities):
+            codes[values == severity] = code
+    else:
+        known = ~np.isnan(values)
+        codes[known] = values[known].astype(np.int8)
+    # Columns go condition by condition, each with its five levels
+    return codes.reshape(len(frame), len(CONDITIONS), len(Levels)).transpose(0, 2, 1).copy()
+
+def source_signature(path):
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def cache_paths(csv_path, cache_dir=None):
+    cache_dir = cache_dir or os.path.join(os.path.dirname(csv_path) or ".", "cache")
+    stem = os.path.splitext(os.path.basename(csv_path))[0]
+    return {name: os.path.join(cache_dir, f"{stem}.{name}") for name in ("labels.npy", "study_ids.npy", "meta.json")}
+
+class LabelStore:
+    """
+    Labels of every study with vectorized lookups by study id.
+
+    Args:
+        study_ids (numpy.array): sorted int64 study ids
+        labels (numpy.array): matching int8 (studies, levels, conditions) severities, may be a memory map
+    """
+
+    def __init__(self, study_ids, labels):
+        study_ids = np.asarray(study_ids, dtype=np.int64)
+        order = np.argsort(study_ids, kind="stable")
+        if not np.array_equal(order, np.arange(len(order))):
+            study_ids, labels = study_ids[order], labels[order]
+        self.study_ids = study_ids
+        self.labels = labels
+
+    @classmethod
+    def from_csv(cls, csv_path):
+        import pandas as pd
+        frame = pd.read_csv(csv_path, usecols=["study_id"] + CONDITION_COLUMNS)
+        return cls(frame["study_id"].to_numpy(dtype=np.int64), encode_labels(frame))
+
+    @classmethod
+    def load(cls, csv_path="./data/train.csv", cache_dir=None):
+        """Store of a CSV, from its .npy cache while the CSV is unchanged, converting and caching it otherwise."""
+        paths = cache_paths(csv_path, cache_dir)
+        signature = source_signature(csv_path)
+        if all(os.path.exists(path) for path in paths.values()):
+            with open(paths["meta.json"]) as f:
+                if json.load(f) == signature:
+                    return cls(np.load(paths["study_ids.npy"]), np.load(paths["labels.npy"], mmap_mode="r"))
+
+        store = cls.from_csv(csv_path)
+        os.makedirs(os.path.dirname(paths["meta.json"]), exist_ok=True)
+        save_atomic(paths["labels.npy"], lambda f: np.save(f, store.labels))
+        save_atomic(paths["study_ids.npy"], lambda f: np.save(f, store.study_ids))
+        # The metadata goes last, it validates the two arrays
+        save_atomic(paths["meta.json"], lambda f: f.write(json.dumps(signature).encode()))
+        return store
+
+    def __len__(self):
+        return len(self.study_ids)
+
+    def __contains__(self, study_id):
+        row = np.searchsorted(self.study_ids, study_id)
+        return row < len(self.study_ids) and self.study_ids[row] == study_id
+
+    def rows(self, study_ids):
+        """Row of each study id, KeyError if any is not in the store."""
+        study_ids = np.asarray(study_ids, dtype=np.int64)
+        rows = np.searchsorted(self.study_ids, study_ids).clip(max=max(len(self.study_ids) - 1, 0))
+        missing = self.study_ids[rows] != study_ids
+        if missing.any():
+            raise KeyError(f"studies not in the labels: {study_ids[missing].tolist()}")
+        return rows
+
+    def lookup(self, study_ids, levels=None, conditions=None):
+        """
+        Severities of some studies, (studies, levels, conditions) int8 with MISSING where unknown.
+
+        Args:
+            study_ids (array like): study ids, a single id gives a (levels, conditions) array
+            levels (list): level names or indexes, all of them when None
+            conditions (list): condition names or indexes, all of them when None
+        """
+        single = np.ndim(study_ids) == 0
+        labels = self.labels[self.rows(np.atleast_1d(study_ids))]
+        if levels is not None:
+            labels = labels[:, [Levels.index(level) if isinstance(level, str) else level for level in levels]]
+        if conditions is not None:
+            labels = labels[:, :, [CONDITIONS.index(condition) if isinstance(condition, str) else condition
+                                   for condition in conditions]]
+        return labels[0] if single else labels
+
+    def study(self, study_id):
+        """train.csv like row of one study: column -> severity name, None where missing."""
+        labels = self.lookup(study_id)
+        return {
+            f"{condition}_{level}": Severities[labels[level_idx, condition_idx]] if labels[level_idx, condition_idx] >= 0 else None
+            for condition_idx, condition in enumerate(CONDITIONS)
+            for level_idx, level in enumerate(LEVEL_SUFFIXES)
+        }
+
+    def class_frequencies(self, normalize=False):
+        """
+        Count of every severity per level and condition, shape (levels, conditions, severities).
+        Missing labels are not counted, normalize divides by the known labels of each cell.
+        """
+        labels = np.asarray(self.labels)
+        counts = np.stack([(labels == code).sum(axis=0) for code in range(len(Severities))], axis=-1)
+        if normalize:
+            return counts / np.maximum(counts.sum(axis=-1, keepdims=True), 1)
+        return counts
+
+    def missing(self):
+        """Number of missing labels per level and condition."""
+        return (np.asarray(self.labels) == MISSING).sum(axis=0)
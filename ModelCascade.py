@@ -0,0 +1,117 @@
+'''
+Confidence gated cascade of the lumbar models.
+
+The cheaper model (AlexNet) answers every image first. Only the images where the softmax
+confidence of some level falls below the threshold are escalated to the second model (ResNet),
+or to the average of both, reusing the same preprocessed input tensor:
+
+    cascade = ModelCascade("saggital1", threshold=0.6, mode="ensemble")
+    predictions, escalated = cascade.predict_image("./Images/x.dcm")
+    cascade.stats()  # {'images': ..., 'escalations': ..., 'escalation_rate': ...}
+
+'''
+
+import threading
+
+import torch
+
+from InteractiveModels import (
+    iter_batches,
+    load_dicom_image,
+    load_dicom_images,
+    model_device,
+    probabilities_to_predictions,
+    registry,
+    resolve_model_key,
+)
+from Instrumentation import instrumentation
+
+# escalate: the second model answers the escalated images on its own
+# ensemble: the softmax of both models is averaged for the escalated images
+CASCADE_MODES = ["escalate", "ensemble"]
+
+class ModelCascade:
+    """
+    Two stage predictor of one view.
+
+    Args:
+        view (string): saggital1, axial or saggital2
+        threshold (float): lowest confidence of any level accepted from the first model
+        mode (string): one of CASCADE_MODES
+        first (string): cnn run on every image
+        second (string): cnn run on the escalated images
+        backend (string): inference backend of both models, see MODEL_BACKENDS
+    """
+
+    def __init__(self, view, threshold=0.6, mode="escalate", first="alex", second="res", backend="fp32"):
+        if mode not in CASCADE_MODES:
+            raise ValueError(f"{mode} cascade mode is not valid")
+        self.first = resolve_model_key(first, view)
+        self.second = resolve_model_key(second, view)
+        self.view = view
+        self.threshold = threshold
+        self.mode = mode
+        self.backend = backend
+        self._lock = threading.Lock()
+        self.images = 0
+        self.escalations = 0
+
+    def _probabilities(self, key, images):
+        model = registry.get(*key, backend=self.backend)
+        with torch.no_grad():
+            outputs = model(images.to(model_device(model)))
+        return torch.softmax(outputs, dim=2).cpu()
+
+    def predict_tensor(self, images):
+        """
+        Predictions for a preprocessed (batch, 3, 224, 224) tensor.
+
+        Returns:
+            list: one predictions dict per image, same format as predict_image
+            list: whether each image was escalated to the second model
+        """
+        with instrumentation.stage("forward"):
+            probabilities = self._probabilities(self.first, images)
+        # Lowest confidence over the levels of every image
+        escalated = probabilities.max(dim=2).values.min(dim=1).values < self.threshold
+        if escalated.any():
+            with instrumentation.stage("escalation"):
+                second = self._probabilities(self.second, images[escalated])
+            if self.mode == "ensemble":
+                second = (probabilities[escalated] + second) / 2
+            probabilities[escalated] = second
+
+        with self._lock:
+            self.images += len(escalated)
+            self.escalations += int(escalated.sum())
+        return probabilities_to_predictions(probabilities), escalated.tolist()
+
+    def predict_image(self, dicom_path):
+        """Predictions of one DICOM image and whether it was escalated."""
+        with instrumentation.request("cascade"):
+            predictions, escalated = self.predict_tensor(load_dicom_image(dicom_path))
+        return predictions[0], escalated[0]
+
+    def predict_images(self, paths, batch_size=16):
+        """Predictions of many DICOM images, the escalated images of each batch run as one smaller batch."""
+        predictions, escalated = [], []
+        for batch_paths in iter_batches(paths, batch_size):
+            batch_predictions, batch_escalated = self.predict_tensor(load_dicom_images(batch_paths))
+            predictions.extend(batch_predictions)
+            escalated.extend(batch_escalated)
+        return predictions, escalated
+
+    def stats(self):
+        with self._lock:
+            return {
+                "images": self.images,
+                "escalations": self.escalations,
+                "escalation_rate": self.escalations / self.images if self.images else 0.0,
+                "threshold": self.threshold,
+                "mode": self.mode,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.images = 0
+            self.escalations = 0
@@ -0,0 +1,34 @@
+'''
+Network definitions of the lumbar models, kept apart from InteractiveModels so torch and
+torchvision are only imported once a model is actually built.
+
+'''
+
+import torch.nn as nn
+import torchvision.models as models
+
+class CustomAlexNet(nn.Module):
+    def __init__(self, num_levels=5, num_classes=3):
+        self.num_levels = num_levels
+        self.num_classes = num_classes
+        super(CustomAlexNet, self).__init__()
+        self.model = models.alexnet(weights=None)  # Load AlexNet
+        num_ftrs = self.model.classifier[-1].in_features
+        self.model.classifier[-1] = nn.Linear(num_ftrs, num_levels * num_classes)  # Modify to output all levels
+
+    def forward(self, x):
+        x = self.model(x)
+        return x.view(-1, self.num_levels, self.num_classes)  # Reshape to (batch, levels, classes
+
+class CustomResNet(nn.Module):
+    def __init__(self, num_levels=5, num_classes=3):
+        self.num_levels = num_levels
+        self.num_classes = num_classes
+        super(CustomResNet, self).__init__()
+        self.model = models.resnet18(weights=None)  # Load ResNet-18; you could use resnet50 or other versions as well
+        num_ftrs = self.model.fc.in_features
+        self.model.fc = nn.Linear(num_ftrs, num_levels * num_classes)  # Modify the output layer for all levels
+
+    def forward(self, x):
+        x = self.model(x)
+        return x.view(-1, self.num_levels, self.num_classes)  # Reshape to (batch, levels, classe
@@ -0,0 +1,136 @@
+'''
+ONNX export of the lumbar models and an ONNX Runtime model usable in place of the PyTorch ones
+
+    python OnnxBackend.py --cnn alex res     # export and check every view
+
+'''
+
+import os
+import inspect
+import argparse
+
+import numpy as np
+
+from AtomicFiles import atomic_path
+
+# Largest absolute difference allowed between the ONNX Runtime and PyTorch logits
+PARITY_ATOL = 1e-4
+
+def onnx_path(model_path):
+    """Path of the exported model kept next to its .pth checkpoint."""
+    return os.path.splitext(model_path)[0] + ".onnx"
+
+class OnnxModel:
+    """
+    ONNX Runtime session with the same call convention as CustomAlexNet / CustomResNet:
+    a (batch, 3, 224, 224) input gives (batch, 5, 3) logits. Torch tensors in give torch
+    tensors out, so predict_image and predict_images work unchanged; numpy arrays in give
+    numpy arrays out and never touch torch.
+
+    Args:
+        path (string): .onnx file
+        intra_op_threads (int): threads used inside each operator, 0 lets ONNX Runtime decide
+    """
+
+    # predict_image and predict_images feed these models NumPy input, see is_numpy_model
+    numpy_io = True
+
+    def __init__(self, path, intra_op_threads=0):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.path = path
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, images):
+        if isinstance(images, np.ndarray):
+            return self.run(images)
+        import torch
+        return torch.from_numpy(self.run(images.detach().cpu().numpy()))
+
+    def run(self, images):
+        images = np.ascontiguousarray(images, dtype=np.float32)
+        return self.session.run(None, {self.input_name: images})[0]
+
+    def eval(self):
+        return self
+
+def export_onnx(model, path, check=True, opset_version=17):
+    """
+    Export a loaded CustomAlexNet / CustomResNet to ONNX with a dynamic batch dimension,
+    the (batch, 5, 3) reshape of forward included. With check the exported graph is run
+    on a random batch and the file is removed if it does not match the PyTorch logits.
+    """
+    import torch
+    from InteractiveModels import IMAGE_SIZE
+
+    model = model.cpu().eval()
+    example = torch.rand(2, 3, *IMAGE_SIZE)
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False  # The TorchScript exporter handles dynamic_axes without onnxscript
+    # A graph failing the parity check never replaces the previous export
+    with atomic_path(path) as tmp_path:
+        torch.onnx.export(
+            model,
+            example,
+            tmp_path,
+            input_names=["image"],
+            output_names=["logits"],
+            dynamic_axes={"image": {0: "batch"}, "logits": {0: "batch"}},
+            opset_version=opset_version,
+            **kwargs,
+        )
+        if check:
+            check_parity(model, OnnxModel(tmp_path))
+    return path
+
+def check_parity(model, onnx_model, batch_size=4, atol=PARITY_ATOL, seed=0):
+    """Raise AssertionError if the ONNX logits differ from the PyTorch ones by more than atol."""
+    import torch
+    from InteractiveModels import IMAGE_SIZE
+
+    generator = torch.Generator().manual_seed(seed)
+    images = torch.rand(batch_size, 3, *IMAGE_SIZE, generator=generator)
+    with torch.no_grad():
+        expected = model.cpu()(images).numpy()
+    actual = onnx_model.run(images.numpy())
+    difference = float(np.abs(expected - actual).max())
+    if actual.shape != expected.shape or difference > atol:
+        raise AssertionError(
+            f"ONNX output {actual.shape} differs from PyTorch {expected.shape} by {difference} (atol {atol})"
+        )
+    return difference
+
+def load_onnx_model(cnn, view, intra_op_threads=0):
+    """ONNX Runtime model for (cnn, view), exporting the checkpoint the first time or when it changed."""
+    from InteractiveModels import CNN_MODELS, build_model, resolve_model_key
+
+    cnn, view = resolve_model_key(cnn, view)
+    model_path = CNN_MODELS[cnn][1][view]
+    path = onnx_path(model_path)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(model_path):
+        export_onnx(build_model(cnn, view), path)
+    return OnnxModel(path, intra_op_threads)
+
+def main(argv=None):
+    from InteractiveModels import CNN_MODELS, VIEWS, build_model, resolve_model_key
+
+    parser = argparse.ArgumentParser(description="Export the lumbar models to ONNX and check them against PyTorch")
+    parser.add_argument("--cnn", nargs="+", default=["alex", "res"], choices=["alex", "res"])
+    parser.add_argument("--views", nargs="+", default=VIEWS, choices=VIEWS)
+    parser.add_argument("--atol", type=float, default=PARITY_ATOL)
+    args = parser.parse_args(argv)
+
+    for cnn in args.cnn:
+        for view in args.views:
+            key = resolve_model_key(cnn, view)
+            model = build_model(*key)
+            path = export_onnx(model, onnx_path(CNN_MODELS[key[0]][1][view]), check=False)
+            difference = check_parity(model, OnnxModel(path), atol=args.atol)
+            print(f"{path}: max difference {difference:.2e}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+'''
+SQLite index of the patients, their uploaded DICOMs and the stored predictions,
+so the GUI pages query it instead of listing ./Images and re-running inference.
+
+'''
+
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+from InteractiveModels import file_content_hash
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    folder TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS uploads (
+    id INTEGER PRIMARY KEY,
+    patient_id INTEGER NOT NULL REFERENCES patients(id),
+    path TEXT NOT NULL UNIQUE,
+    content_hash TEXT NOT NULL,
+    series_type TEXT,
+    uploaded_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS uploads_patient ON uploads(patient_id, uploaded_at DESC);
+CREATE INDEX IF NOT EXISTS uploads_hash ON uploads(content_hash);
+CREATE TABLE IF NOT EXISTS predictions (
+    id INTEGER PRIMARY KEY,
+    upload_id INTEGER NOT NULL REFERENCES uploads(id),
+    cnn TEXT NOT NULL,
+    view TEXT NOT NULL,
+    predictions TEXT NOT NULL,
+    saliency_path TEXT,
+    created_at TEXT NOT NULL,
+    UNIQUE (upload_id, cnn, view)
+);
+"""
+
+# Name given by the GUI to the uploaded files
+UPLOAD_TIME_FORMAT = "%d-%m-%y_%H-%M-%S"
+
+def upload_time(path):
+    """Upload time from the file name written by the GUI, the modification time otherwise."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    try:
+        return datetime.strptime(stem, UPLOAD_TIME_FORMAT).isoformat()
+    except ValueError:
+        return datetime.fromtimestamp(os.path.getmtime(path)).isoformat()
+
+def read_series_type(path):
+    """SeriesDescription of a DICOM without reading its pixel data."""
+    import pydicom
+    try:
+        return getattr(pydicom.dcmread(path, stop_before_pixels=True), "SeriesDescription", None)
+    except Exception:
+        return None
+
+class PatientStore:
+    """
+    SQLite backed index of patients, uploads and predictions.
+
+    Args:
+        db_path (string): database file, created if it does not exist
+        images_root (string): folder with one sub folder per patient, as written by the GUI
+    """
+
+    def __init__(self, db_path="./Images/index.sqlite3", images_root="./Images"):
+        self.images_root = images_root
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(SCHEMA)
+
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            return [dict(row) for row in self._connection.execute(sql, parameters)]
+
+    def _execute(self, sql, parameters=()):
+        with self._lock, self._connection:
+            return self._connection.execute(sql, parameters).lastrowid
+
+    # Patients
+
+    def add_patient(self, name, folder=None):
+        """Register a patient if it is not already, returns its id."""
+        folder = folder or os.path.join(self.images_root, name.replace(" ", "_"))
+        self._execute(
+            "INSERT OR IGNORE INTO patients (name, folder, created_at) VALUES (?, ?, ?)",
+            (name, folder, datetime.now().isoformat()),
+        )
+        return self.patient(name)["id"]
+
+    def patient(self, name):
+        rows = self._query("SELECT * FROM patients WHERE name = ?", (name,))
+        return rows[0] if rows else None
+
+    def patient_by_folder(self, folder):
+        """Patient of a folder, either its path or its name under images_root as the GUI links carry it."""
+        if os.path.basename(folder) == folder:
+            folder = os.path.join(self.images_root, folder)
+        rows = self._query("SELECT * FROM patients WHERE folder = ?", (folder,))
+        return rows[0] if rows else None
+
+    def _patient_id(self, patient):
+        """Id of a patient given by id or by name, None if there is no such patient."""
+        if isinstance(patient, int):
+            return patient
+        patient_row = self.patient(patient)
+        return patient_row["id"] if patient_row is not None else None
+
+    def patients(self, offset=0, limit=20):
+        """Page of patients ordered by name, with their number of uploads."""
+        return self._query(
+            """
+            SELECT patients.*, COUNT(uploads.id) AS uploads
+            FROM patients LEFT JOIN uploads ON uploads.patient_id = patients.id
+            GROUP BY patients.id ORDER BY patients.name LIMIT ? OFFSET ?
+            """,
+            (limit, offset),
+        )
+
+    def count_patients(self):
+        return self._query("SELECT COUNT(*) AS n FROM patients")[0]["n"]
+
+    # Uploads
+
+    def add_upload(self, patient, path, content_hash=None, series_type=None, uploaded_at=None):
+        """
+        Index an uploaded DICOM of a patient (name or id), returns the upload id.
+        A path already indexed returns its id without reading the file again.
+        """
+        existing = self.upload(path)
+        if existing is not None:
+            return existing["id"]
+        patient_id = patient if isinstance(patient, int) else self.add_patient(patient)
+        if content_hash is None:
+            content_hash = file_content_hash(path)[0]
+        self._execute(
+            """
+            INSERT OR IGNORE INTO uploads (patient_id, path, content_hash, series_type, uploaded_at)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (patient_id, path, content_hash, series_type or read_series_type(path), uploaded_at or upload_time(path)),
+        )
+        return self.upload(path)["id"]
+
+    def upload(self, path):
+        rows = self._query("SELECT * FROM uploads WHERE path = ?", (path,))
+        return rows[0] if rows else None
+
+    def uploads(self, patient, offset=0, limit=10):
+        """Page of the uploads of a patient (id or name), newest first, each with its stored predictions."""
+        patient_id = self._patient_id(patient)
+        if patient_id is None:
+            return []
+        uploads = self._query(
+            "SELECT * FROM uploads WHERE patient_id = ? ORDER BY uploaded_at DESC, id DESC LIMIT ? OFFSET ?",
+            (patient_id, limit, offset),
+        )
+        for upload in uploads:
+            upload["predictions"] = self.predictions(upload["id"])
+        return uploads
+
+    def count_uploads(self, patient):
+        """Number of uploads of a patient (id or name)."""
+        patient_id = self._patient_id(patient)
+        if patient_id is None:
+            return 0
+        return self._query("SELECT COUNT(*) AS n FROM uploads WHERE patient_id = ?", (patient_id,))[0]["n"]
+
+    # Predictions
+
+    def save_prediction(self, upload_id, cnn, view, predictions, saliency_path=None):
+        self._execute(
+            """
+            INSERT OR REPLACE INTO predictions (upload_id, cnn, view, predictions, saliency_path, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (upload_id, cnn, view, json.dumps(predictions), saliency_path, datetime.now().isoformat()),
+        )
+
+    def predictions(self, upload_id):
+        rows = self._query("SELECT * FROM predictions WHERE upload_id = ? ORDER BY created_at", (upload_id,))
+        for row in rows:
+            row["predictions"] = json.loads(row["predictions"])
+        return rows
+
+    def prediction(self, upload_id, cnn, view):
+        rows = self._query(
+            "SELECT * FROM predictions WHERE upload_id = ? AND cnn = ? AND view = ?", (upload_id, cnn, view)
+        )
+        if not rows:
+            return None
+        rows[0]["predictions"] = json.loads(rows[0]["predictions"])
+        return rows[0]
+
+    # Ingestion
+
+    def ingest(self):
+        """
+        Index the patient folders and .dcm files under images_root that are not in the database yet.
+        Files already indexed are skipped without being read, returns the number of new uploads.
+        """
+        if not os.path.isdir(self.images_root):
+            return 0
+        known_paths = {row["path"] for row in self._query("SELECT path FROM uploads")}
+        known_patients = {row["folder"]: row["id"] for row in self._query("SELECT id, folder FROM patients")}
+        added = 0
+        for entry in sorted(os.scandir(self.images_root), key=lambda entry: entry.name):
+            if not entry.is_dir():
+                continue
+            folder = os.path.join(self.images_root, entry.name)
+            patient_id = known_patients.get(folder)
+            if patient_id is None:
+                patient_id = self.add_patient(entry.name.replace("_", " "), folder)
+            for file_entry in os.scandir(folder):
+                path = os.path.join(folder, file_entry.name)
+                if file_entry.name.lower().endswith(".dcm") and path not in known_paths:
+                    self.add_upload(patient_id, path)
+                    added += 1
+        return added
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,119 @@
+'''
+Small renders of the uploaded DICOMs and their saliency overlays, written once next to the
+DICOM so the patient history is served from image files instead of decoding every DICOM.
+
+'''
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, features
+
+from AtomicFiles import save_atomic
+from InteractiveModels import dicom_cache
+
+# Longest side of the thumbnails in pixels
+THUMBNAIL_SIZE = 256
+
+# WebP when Pillow was built with it, PNG otherwise
+THUMBNAIL_FORMAT = "webp" if features.check("webp") else "png"
+
+def thumbnail_path(dicom_path, fmt=THUMBNAIL_FORMAT):
+    return f"{os.path.splitext(dicom_path)[0]}.thumb.{fmt}"
+
+def overlay_path(dicom_path, cnn, view):
+    """Full size overlay, as saved by the results page."""
+    return f"{os.path.splitext(dicom_path)[0]}.{cnn}.{view}.saliency.png"
+
+def overlay_thumbnail_path(dicom_path, cnn, view, fmt=THUMBNAIL_FORMAT):
+    return f"{os.path.splitext(dicom_path)[0]}.{cnn}.{view}.saliency.thumb.{fmt}"
+
+def save_image(image, path):
+    """Write through a temporary file so readers never see a partial image."""
+    return save_atomic(path, lambda f: image.save(f, format=os.path.splitext(path)[1][1:].upper()))
+
+def shrink(image, size=THUMBNAIL_SIZE):
+    image = image.copy()
+    image.thumbnail((size, size), Image.BILINEAR)
+    return image
+
+def render_thumbnail(dicom_path, size=THUMBNAIL_SIZE, fmt=THUMBNAIL_FORMAT):
+    """
+    Write the thumbnail of a DICOM from the display pixels of the shared dicom_cache, the same
+    decode the GUI and the model use, returns the thumbnail path.
+    """
+    image = Image.fromarray(dicom_cache.display(dicom_path))
+    return save_image(shrink(image, size), thumbnail_path(dicom_path, fmt))
+
+def save_overlay(dicom_path, cnn, view, overlayed_image, size=THUMBNAIL_SIZE, fmt=THUMBNAIL_FORMAT):
+    """
+    Write the full size overlay returned by process_image and its thumbnail next to the DICOM.
+    Returns (overlay path, thumbnail path).
+    """
+    image = Image.fromarray((np.clip(overlayed_image, 0, 1) * 255).astype(np.uint8))
+    full_path = save_image(image, overlay_path(dicom_path, cnn, view))
+    return full_path, save_image(shrink(image, size), overlay_thumbnail_path(dicom_path, cnn, view, fmt))
+
+def thumbnail(dicom_path):
+    """Path of the thumbnail of a DICOM, rendering it now if it was never rendered."""
+    path = thumbnail_path(dicom_path)
+    if os.path.exists(path):
+        return path
+    return render_thumbnail(dicom_path)
+
+def overlay_thumbnail(dicom_path, cnn, view):
+    """Path of the overlay thumbnail, made from the full size overlay if only that one exists, else None."""
+    path = overlay_thumbnail_path(dicom_path, cnn, view)
+    if os.path.exists(path):
+        return path
+    full_path = overlay_path(dicom_path, cnn, view)
+    if os.path.exists(full_path):
+        with Image.open(full_path) as image:
+            return save_image(shrink(image), path)
+    return None
+
+class Renderer:
+    """
+    Background renders of the uploads: the thumbnail and, given a diagnose function, the saliency
+    overlay of each upload are produced on a small thread pool while the page keeps serving.
+    """
+
+    def __init__(self, workers=2):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="render")
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, dicom_path, diagnose=None):
+        """
+        Queue the renders of an upload, at most once at a time per file.
+
+        Args:
+            dicom_path (string): uploaded .dcm file
+            diagnose (callable): optional diagnose(dicom_path) run after the thumbnail,
+                e.g. computing and storing the prediction and its overlay
+        """
+        with self._lock:
+            future = self._pending.get(dicom_path)
+            if future is not None and not future.done():
+                return future
+            future = self.executor.submit(self._render, dicom_path, diagnose)
+            self._pending[dicom_path] = future
+        future.add_done_callback(lambda _: self._forget(dicom_path, future))
+        return future
+
+    def _forget(self, dicom_path, future):
+        with self._lock:
+            if self._pending.get(dicom_path) is future:
+                del self._pending[dicom_path]
+
+    @staticmethod
+    def _render(dicom_path, diagnose):
+        thumbnail(dicom_path)
+        if diagnose is not None:
+            diagnose(dicom_path)
+
+    def pending(self):
+        with self._lock:
+            return [path for path, future in self._pending.items() if not future.done()]
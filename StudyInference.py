@@ -0,0 +1,214 @@
+'''
+Python module that runs the lumbar models over a whole study, every slice of every series,
+and aggregates the predictions into the condition columns used in data/train.csv
+
+'''
+
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pydicom
+import torch
+from PIL import Image
+
+from InteractiveModels import IMAGE_SIZE, dicom_to_uint8, iter_batches, model_device, registry
+from LabelStore import CONDITION_COLUMNS, LEVEL_SUFFIXES, Severities
+
+# Conditions predicted from each series model. The models do not tell left from right, so the
+# same per-level prediction fills both sides of the bilateral conditions
+VIEW_CONDITIONS = {
+    "saggital1": ["left_neural_foraminal_narrowing", "right_neural_foraminal_narrowing"],
+    "saggital2": ["spinal_canal_stenosis"],
+    "axial": ["left_subarticular_stenosis", "right_subarticular_stenosis"],
+}
+
+def series_view(description):
+    """
+    Model view for a series description such as the ones in train_series_descriptions.csv:
+        Sagittal T1 -> saggital1
+        Sagittal T2/STIR -> saggital2
+        Axial T2 -> axial
+    Returns None when the description does not match any model.
+    """
+    description = (description or "").lower()
+    if "axial" in description:
+        return "axial"
+    if "sag" in description and "t1" in description:
+        return "saggital1"
+    if "sag" in description and ("t2" in description or "stir" in description):
+        return "saggital2"
+    return None
+
+def find_series(study_dir, series_descriptions=None):
+    """
+    Group the .dcm files of a study by series directory and route each series to its view.
+
+    Args:
+        study_dir (string): directory with one sub directory per series, as in train_images/<study_id>
+        series_descriptions (dict): optional series_id -> description, otherwise the
+            SeriesDescription of the first slice of each series is used
+
+    Returns:
+        dict: view -> list of slice paths, sorted by instance number when the names are numeric
+    """
+    by_directory = defaultdict(list)
+    for root, _, files in os.walk(study_dir):
+        for name in files:
+            if name.lower().endswith(".dcm"):
+                by_directory[root].append(os.path.join(root, name))
+
+    views = defaultdict(list)
+    for directory, paths in sorted(by_directory.items()):
+        paths.sort(key=slice_sort_key)
+        series_id = os.path.basename(directory)
+        description = None
+        if series_descriptions is not None:
+            description = series_descriptions.get(series_id, series_descriptions.get(str(series_id)))
+        if description is None:
+            header = pydicom.dcmread(paths[0], stop_before_pixels=True)
+            description = getattr(header, "SeriesDescription", None)
+        view = series_view(description)
+        if view is not None:
+            views[view].extend(paths)
+    return dict(views)
+
+def slice_sort_key(path):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return (0, int(stem), "") if stem.isdigit() else (1, 0, stem)
+
+def decode_slice(dicom_path):
+    """
+    Decode one slice and resize it to the model input size, runs in the worker processes.
+    Returns a (224, 224) uint8 array, the same values the module transform produces before ToTensor.
+    """
+    return resize_slice(pydicom.dcmread(dicom_path))
+
+def resize_slice(dataset):
+    """decode_slice for a dataset that is already read."""
+    image = Image.fromarray(dicom_to_uint8(dataset))
+    if image.mode != "L":
+        image = image.convert("L")
+    return np.asarray(image.resize(IMAGE_SIZE[::-1], Image.BILINEAR))
+
+def slices_to_tensor(slices):
+    """Stack resized uint8 slices into a (batch, 3, 224, 224) float tensor."""
+    batch = torch.from_numpy(np.stack(slices)).unsqueeze(1).float().div_(255.0)
+    return batch.expand(-1, 3, -1, -1)
+
+def predict_slices(model, slices, batch_size=32, device=None, temperature=1.0):
+    """
+    Softmax probabilities of decoded slices, shape (slices, levels, classes), one forward pass per
+    batch of at most batch_size slices. temperature divides the logits, see ViewFusion.fit_temperature.
+    """
+    if device is None:
+        device = model_device(model)
+    probabilities = []
+    for batch in iter_batches(slices, batch_size):
+        with torch.no_grad():
+            outputs = model(slices_to_tensor(batch).to(device))
+        probabilities.append(torch.softmax(outputs.cpu() / temperature, dim=2))
+    return torch.cat(probabilities)
+
+def predict_series(model, paths, pool, batch_size=32, device=None):
+    """
+    Softmax probabilities of every slice of a series, shape (slices, levels, classes).
+    Slices are decoded by the pool while the previous batches go through the model.
+    """
+    decoded = pool.map(decode_slice, paths, chunksize=max(1, batch_size // 4)) if pool is not None else map(decode_slice, paths)
+    return predict_slices(model, decoded, batch_size, device)
+
+def aggregate_slices(probabilities, method="mean"):
+    """
+    Combine the per-slice probabilities of a series into one (levels, classes) distribution.
+
+    Args:
+        probabilities (torch.Tensor): (slices, levels, classes) softmax outputs
+        method (string):
+            mean: average distribution across slices
+            max: per level, the distribution of the slice most confident in a non normal class
+    """
+    if method == "mean":
+        return probabilities.mean(dim=0)
+    if method == "max":
+        abnormal = probabilities[:, :, 1:].sum(dim=2)  # (slices, levels)
+        best = abnormal.argmax(dim=0)
+        return probabilities[best, torch.arange(probabilities.shape[1])]
+    raise ValueError(f"{method} aggregation is not valid")
+
+def prediction_entry(distribution):
+    """{'Class', 'Confidence', 'Probabilities'} of one (classes,) distribution."""
+    confidence, class_idx = distribution.max(dim=0)
+    return {
+        'Class': Severities[class_idx.item()],
+        'Confidence': confidence.item(),
+        'Probabilities': distribution.tolist(),
+    }
+
+def view_columns(view, distribution):
+    """column -> prediction entry of the conditions of a view, from its (levels, classes) distribution."""
+    columns = {}
+    for level_idx, level in enumerate(LEVEL_SUFFIXES):
+        entry = prediction_entry(distribution[level_idx])
+        for condition in VIEW_CONDITIONS[view]:
+            columns[f"{condition}_{level}"] = entry
+    return columns
+
+def predict_study(study_dir, cnn="alex", series_descriptions=None, batch_size=32, workers=None, aggregate="mean",
+                  pool=None):
+    """
+    Predict the 25 conditions of data/train.csv for a whole study.
+
+    Args:
+        study_dir (string): directory of the study, one sub directory per series
+        cnn (string): alex or res (alexnet / resnet are accepted too)
+        series_descriptions (dict): optional series_id -> series description
+        batch_size (int): slices per forward pass
+        workers (int): processes decoding DICOMs, 0 decodes in this process
+        aggregate (string): how slices are combined, see aggregate_slices
+        pool (Executor): optional executor decoding the slices, reused across studies and shut
+            down by the caller. When None a pool of `workers` processes is created for this
+            study and shut down before returning
+
+    Returns:
+        dict: { column : {
+                    'Class': severity as written in train.csv,
+                    'Confidence': float,
+                    'Probabilities': list with the probability of each severity
+                }
+            } for every column of CONDITION_COLUMNS the study has a series for
+    """
+    views = find_series(study_dir, series_descriptions)
+    result = {}
+    owned = pool is None and workers != 0
+    if owned:
+        pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        for view, paths in views.items():
+            model = registry.get(cnn, view)
+            probabilities = predict_series(model, paths, pool, batch_size)
+            result.update(view_columns(view, aggregate_slices(probabilities, aggregate)))
+    finally:
+        if owned:
+            pool.shutdown()
+    return {column: result[column] for column in CONDITION_COLUMNS if column in result}
+
+def study_to_row(study_id, study_result):
+    """Flatten a predict_study result into a train.csv like row, missing conditions are None."""
+    row = {"study_id": study_id}
+    for column in CONDITION_COLUMNS:
+        row[column] = study_result[column]['Class'] if column in study_result else None
+    return row
+
+def read_study_ids(path):
+    """
+    Study ids of a split file: a CSV with a study_id column, or plain text with one id per line.
+    See Evaluation.split_description for why the held-out studies come from such a file.
+    """
+    with open(path) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    if lines and not lines[0].split(",")[0].isdigit():
+        import csv
+        return sorted({int(row["study_id"]) for row in csv.DictReader(lines)})
+    return sorted({int(line) for line in lines})
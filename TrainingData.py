@@ -0,0 +1,404 @@
+'''
+Training data pipeline over a pre-decoded slice store.
+
+The training DICOMs are decoded once into a memory mapped (slices, 224, 224) uint8 array, next to
+an index of study, series, instance, view and level of every slice and the per level labels of
+data/train_cleaned.csv. Training batches are then gathered straight from the map by a multi-worker
+DataLoader instead of calling pydicom.dcmread in every __getitem__:
+
+    python TrainingData.py build /kaggle/input/.../train_images ./slice_store --workers 8
+    python TrainingData.py benchmark ./slice_store --view saggital2
+
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pydicom
+import torch
+from torch.utils.data import BatchSampler, DataLoader, Dataset, RandomSampler, SequentialSampler
+
+from AtomicFiles import atomic_path
+from InteractiveModels import IMAGE_SIZE, VIEWS, Levels, dicom_to_uint8, get_transform
+from LabelStore import LabelStore
+from StudyInference import VIEW_CONDITIONS, decode_slice, find_series
+
+INDEX_DTYPE = np.dtype([
+    ("study_id", np.int64),
+    ("series_id", np.int64),
+    ("instance_number", np.int32),
+    ("view", np.int8),
+    # Level annotated on the slice in train_label_coordinates.csv, -1 when unknown
+    ("level", np.int8),
+])
+
+# Files of a store, meta.json is written last and marks the store as complete
+STORE_FILES = {
+    "slices": "slices.npy",
+    "index": "index.npy",
+    "labels": "labels.npy",
+    "paths": "paths.txt",
+    "meta": "meta.json",
+}
+
+def store_paths(store_dir):
+    return {name: os.path.join(store_dir, file_name) for name, file_name in STORE_FILES.items()}
+
+def store_exists(store_dir):
+    return os.path.exists(store_paths(store_dir)["meta"])
+
+def read_series_descriptions(path):
+    """series_id -> description from a train_series_descriptions.csv file."""
+    frame = pd.read_csv(path)
+    return dict(zip(frame["series_id"].astype(str), frame["series_description"]))
+
+def read_coordinates(path):
+    """(study_id, series_id, instance_number) -> level index from a train_label_coordinates.csv file."""
+    frame = pd.read_csv(path)
+    levels = {level: i for i, level in enumerate(Levels)}
+    return {
+        (int(study_id), int(series_id), int(instance_number)): levels[level]
+        for study_id, series_id, instance_number, level in zip(
+            frame["study_id"], frame["series_id"], frame["instance_number"], frame["level"]
+        )
+        if level in levels
+    }
+
+def instance_number(path):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return int(stem) if stem.isdigit() else -1
+
+def list_training_slices(images_root, labels, series_descriptions=None, coordinates=None):
+    """
+    Slices of the labelled studies found under images_root.
+
+    Args:
+        images_root (string): train_images directory, one folder per study
+        labels (LabelStore): labels of the studies
+        series_descriptions (dict): optional series_id -> description, see find_series
+        coordinates (dict): optional (study, series, instance) -> level, only those slices are kept
+
+    Returns:
+        list: paths of the slices
+        numpy.array: INDEX_DTYPE record of each slice
+        numpy.array: (slices, levels) int8 severities of the condition of the slice's view, -1 when missing
+    """
+    paths, records, slice_labels = [], [], []
+    for study_id in labels.study_ids.tolist():
+        study_dir = os.path.join(images_root, str(study_id))
+        if not os.path.isdir(study_dir):
+            continue
+        for view, view_paths in sorted(find_series(study_dir, series_descriptions).items()):
+            # Same labels the view models are scored against in backend_report
+            view_labels = labels.lookup(study_id, conditions=[VIEW_CONDITIONS[view][0]])[:, 0]
+            for path in view_paths:
+                series_name = os.path.basename(os.path.dirname(path))
+                series_id = int(series_name) if series_name.isdigit() else -1
+                number = instance_number(path)
+                level = -1
+                if coordinates is not None:
+                    level = coordinates.get((int(study_id), series_id, number))
+                    if level is None:
+                        continue
+                paths.append(path)
+                records.append((study_id, series_id, number, VIEWS.index(view), level))
+                slice_labels.append(view_labels)
+    index = np.array(records, dtype=INDEX_DTYPE)
+    slice_labels = np.array(slice_labels, dtype=np.int8).reshape(-1, len(Levels))
+    return paths, index, slice_labels
+
+def build_slice_store(images_root, store_dir, labels_path="./data/train_cleaned.csv", series_descriptions_path=None,
+                      coordinates_path=None, workers=None, overwrite=False):
+    """
+    Decode the training slices once into store_dir. The slices are resized to the model input
+    size exactly like the inference path (decode_slice) and written into a memory mapped .npy.
+    An existing complete store is kept unless overwrite is True. Returns the opened SliceStore.
+    """
+    if store_exists(store_dir) and not overwrite:
+        return SliceStore(store_dir)
+    labels = LabelStore.load(labels_path)
+    series_descriptions = read_series_descriptions(series_descriptions_path) if series_descriptions_path else None
+    coordinates = read_coordinates(coordinates_path) if coordinates_path else None
+    paths, index, slice_labels = list_training_slices(images_root, labels, series_descriptions, coordinates)
+
+    os.makedirs(store_dir, exist_ok=True)
+    files = store_paths(store_dir)
+    if os.path.exists(files["meta"]):
+        os.remove(files["meta"])
+    with atomic_path(files["slices"]) as tmp_path:
+        slices = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=(len(paths), *IMAGE_SIZE))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for i, image in enumerate(pool.map(decode_slice, paths, chunksize=16)):
+                slices[i] = image
+        slices.flush()
+        del slices
+    np.save(files["index"], index)
+    np.save(files["labels"], slice_labels)
+    with open(files["paths"], "w") as f:
+        f.write("".join(f"{path}\n" for path in paths))
+
+    meta = {
+        "slices": len(paths),
+        "image_size": list(IMAGE_SIZE),
+        "views": VIEWS,
+        "levels": Levels,
+        "labels": os.path.abspath(labels_path),
+        "images_root": os.path.abspath(images_root),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    with open(files["meta"], "w") as f:
+        json.dump(meta, f, indent=2)
+    return SliceStore(store_dir)
+
+class SliceStore:
+    """
+    Read only view of a slice store. slices is a read only memory map, index and labels are
+    small enough to be loaded whole and paths, the source DICOM of each slice, is read on demand.
+    """
+
+    def __init__(self, store_dir):
+        if not store_exists(store_dir):
+            raise FileNotFoundError(f"{store_dir} is not a complete slice store, build it first")
+        self.store_dir = store_dir
+        files = store_paths(store_dir)
+        with open(files["meta"]) as f:
+            self.meta = json.load(f)
+        self.slices = np.load(files["slices"], mmap_mode="r")
+        self.index = np.load(files["index"])
+        self.labels = np.load(files["labels"])
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def paths(self):
+        with open(store_paths(self.store_dir)["paths"]) as f:
+            return np.array(f.read().splitlines())
+
+    def select(self, view=None, studies=None, level=None):
+        """Positions of the slices of a view, of some studies and of a level, all of them when None."""
+        mask = np.ones(len(self.index), dtype=bool)
+        if view is not None:
+            mask &= self.index["view"] == VIEWS.index(view)
+        if studies is not None:
+            mask &= np.isin(self.index["study_id"], np.asarray(studies))
+        if level is not None:
+            mask &= self.index["level"] == (Levels.index(level) if isinstance(level, str) else level)
+        return np.flatnonzero(mask)
+
+    def split(self, positions, val_fraction=0.2, seed=42):
+        """Train and validation positions split by study, so no study has slices on both sides."""
+        studies = np.unique(self.index["study_id"][positions])
+        rng = np.random.default_rng(seed)
+        val_studies = rng.choice(studies, size=int(round(len(studies) * val_fraction)), replace=False)
+        in_val = np.isin(self.index["study_id"][positions], val_studies)
+        return positions[~in_val], positions[in_val]
+
+class Augment:
+    """
+    CPU augmentation of a (batch, height, width) uint8 batch into (batch, 3, height, width) floats:
+    random translation of up to max_shift pixels and per image brightness and contrast jitter.
+    There is no vertical flip, the level labels go from top to bottom.
+
+    Args:
+        max_shift (int): largest translation in pixels along each axis
+        brightness (float): largest offset added to the [0, 1] intensities
+        contrast (float): largest relative change of the contrast
+        horizontal_flip (bool): also flip left and right half of the time
+    """
+
+    def __init__(self, max_shift=16, brightness=0.1, contrast=0.1, horizontal_flip=False):
+        self.max_shift = max_shift
+        self.brightness = brightness
+        self.contrast = contrast
+        self.horizontal_flip = horizontal_flip
+
+    def __call__(self, images):
+        batch, height, width = images.shape
+        images = images.float().div_(255.0)
+        if self.max_shift:
+            padded = torch.nn.functional.pad(images, (self.max_shift,) * 4)
+            offsets = torch.randint(0, 2 * self.max_shift + 1, (batch, 2)).tolist()
+            images = torch.stack([padded[i, y:y + height, x:x + width] for i, (y, x) in enumerate(offsets)])
+        if self.horizontal_flip:
+            flip = torch.rand(batch) < 0.5
+            images[flip] = images[flip].flip(-1)
+        if self.contrast or self.brightness:
+            mean = images.mean(dim=(1, 2), keepdim=True)
+            scale = 1 + (torch.rand(batch, 1, 1) * 2 - 1) * self.contrast
+            offset = (torch.rand(batch, 1, 1) * 2 - 1) * self.brightness
+            images = images.sub_(mean).mul_(scale).add_(mean + offset).clamp_(0, 1)
+        return images.unsqueeze(1).expand(-1, 3, -1, -1)
+
+class SliceBatches(Dataset):
+    """
+    Dataset indexed by whole batches of store positions, used with a BatchSampler and
+    batch_size=None: each batch is one gather from the memory map into a single tensor,
+    without per slice tensors or a collate step.
+
+    The map is opened lazily in every worker process instead of being pickled to it.
+    """
+
+    def __init__(self, store_dir, positions, augment=None):
+        self.store_dir = store_dir
+        self.positions = np.asarray(positions)
+        self.augment = augment
+        self._store = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_store"] = None
+        return state
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = SliceStore(self.store_dir)
+        return self._store
+
+    def __getitem__(self, batch):
+        # Sorted positions read the map front to back
+        positions = np.sort(self.positions[np.asarray(batch)])
+        images = torch.from_numpy(self.store.slices[positions])
+        labels = torch.from_numpy(self.store.labels[positions].astype(np.int64))
+        if self.augment is not None:
+            images = self.augment(images)
+        else:
+            images = images.unsqueeze(1).float().div_(255.0).expand(-1, 3, -1, -1)
+        return images, labels
+
+def make_loader(store_dir, positions, batch_size=32, shuffle=True, augment=None, workers=4,
+                prefetch_factor=4, pin_memory=None):
+    """
+    DataLoader of (images, labels) batches: (batch, 3, 224, 224) floats in [0, 1] and
+    (batch, levels) severities, -1 where the label is missing (use ignore_index=-1).
+    """
+    sampler = RandomSampler(positions) if shuffle else SequentialSampler(positions)
+    return DataLoader(
+        SliceBatches(store_dir, positions, augment),
+        batch_size=None,
+        sampler=BatchSampler(sampler, batch_size, drop_last=False),
+        num_workers=workers,
+        prefetch_factor=prefetch_factor if workers else None,
+        persistent_workers=workers > 0,
+        pin_memory=torch.cuda.is_available() if pin_memory is None else pin_memory,
+    )
+
+def create_loaders(store_dir, view, batch_size=32, val_fraction=0.2, seed=42, augment=None, workers=4, prefetch_factor=4):
+    """
+    Train and validation loaders of a view, the store counterpart of the notebooks'
+    create_datasets_and_loaders. Augmentation only applies to the training loader.
+    Returns (train loader, validation loader, train slices, validation slices).
+    """
+    store = SliceStore(store_dir)
+    train_positions, val_positions = store.split(store.select(view), val_fraction, seed)
+    augment = Augment() if augment is None else augment
+    train_loader = make_loader(store_dir, train_positions, batch_size, True, augment, workers, prefetch_factor)
+    val_loader = make_loader(store_dir, val_positions, batch_size, False, None, workers, prefetch_factor)
+    return train_loader, val_loader, len(train_positions), len(val_positions)
+
+class DicomFiles(Dataset):
+    """
+    Per file baseline like the notebooks' MRIData: every item reads and decodes its DICOM.
+    With augment the decoded slice goes through the same Augment as the store batches.
+    """
+
+    def __init__(self, paths, labels, augment=None):
+        self.paths = paths
+        self.labels = labels
+        self.augment = augment
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i):
+        if self.augment is not None:
+            image = self.augment(torch.from_numpy(decode_slice(self.paths[i])).unsqueeze(0))[0]
+        else:
+            image = get_transform()(dicom_to_uint8(pydicom.dcmread(self.paths[i])))
+        return image, torch.from_numpy(self.labels[i].astype(np.int64))
+
+def loader_throughput(loader, batches):
+    """Slices per second over the first batches of a loader, worker start up included."""
+    start = time.perf_counter()
+    slices = 0
+    for i, (images, _) in enumerate(loader):
+        slices += len(images)
+        if i + 1 == batches:
+            break
+    return slices / (time.perf_counter() - start)
+
+def benchmark(store_dir, view=None, batch_size=32, batches=50, workers=4, augment=False, prefetch_factor=4):
+    """
+    Data loading throughput of the per file path against the slice store, over the same slices.
+    Both loaders run with the same workers, prefetch and transform, Augment on both or on neither,
+    so the speedup only measures where the pixels come from.
+    """
+    store = SliceStore(store_dir)
+    positions = store.select(view)
+    transform = Augment() if augment else None
+    file_loader = DataLoader(
+        DicomFiles(store.paths[positions], store.labels[positions], transform),
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=workers,
+        prefetch_factor=prefetch_factor if workers else None,
+        persistent_workers=workers > 0,
+        pin_memory=torch.cuda.is_available(),
+    )
+    results = {
+        "slices": len(positions),
+        "batch_size": batch_size,
+        "batches": batches,
+        "workers": workers,
+        "prefetch_factor": prefetch_factor,
+        "augment": augment,
+        "per_file_slices_per_sec": loader_throughput(file_loader, batches),
+        "store_slices_per_sec": loader_throughput(
+            make_loader(store_dir, positions, batch_size, True, transform, workers, prefetch_factor), batches
+        ),
+    }
+    results["speedup"] = results["store_slices_per_sec"] / results["per_file_slices_per_sec"]
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build and benchmark the pre-decoded training slice store")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="decode the training DICOMs into a slice store")
+    build.add_argument("images_root", help="train_images directory, one folder per study")
+    build.add_argument("store_dir")
+    build.add_argument("--labels", default="./data/train_cleaned.csv")
+    build.add_argument("--series-descriptions", help="train_series_descriptions.csv, read from the DICOMs otherwise")
+    build.add_argument("--coordinates", help="train_label_coordinates.csv, keep only the annotated slices with their level")
+    build.add_argument("--workers", type=int, default=None, help="decoding processes, defaults to the CPU count")
+    build.add_argument("--overwrite", action="store_true")
+
+    bench = commands.add_parser("benchmark", help="compare the loading throughput with the per file path")
+    bench.add_argument("store_dir")
+    bench.add_argument("--view", choices=VIEWS)
+    bench.add_argument("--batch-size", type=int, default=32)
+    bench.add_argument("--batches", type=int, default=50)
+    bench.add_argument("--workers", type=int, default=4, help="loader workers, the same for both paths")
+    bench.add_argument("--augment", action="store_true", help="apply Augment on both paths")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        store = build_slice_store(args.images_root, args.store_dir, args.labels, args.series_descriptions,
+                                  args.coordinates, args.workers, args.overwrite)
+        print(json.dumps(store.meta, indent=2))
+    else:
+        results = benchmark(args.store_dir, args.view, args.batch_size, args.batches, args.workers, args.augment)
+        print(json.dumps(results, indent=2), file=sys.stdout)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+'''
+Multi-view study prediction in one call: every file of a study is decoded once, the saggital1,
+axial and saggital2 models then run concurrently, one worker process per view, over the series
+in batches of a bounded size, and the per-level distributions are merged into a single study report.
+The per-view steps are the ones of StudyInference.predict_study, plus the temperature calibration
+and the most severe finding of each level.
+
+The distributions are temperature calibrated once a calibration file has been fitted on the
+cached held-out features of Evaluation:
+
+    python ViewFusion.py calibrate ./slice_store --cnn alex res --split held_out.csv --output calibration.json
+    python ViewFusion.py predict /kaggle/input/.../train_images/4003253 --cnn alex --calibration calibration.json
+
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import numpy as np
+import torch
+
+from AtomicFiles import save_atomic
+from InteractiveModels import VIEWS, Levels, registry, resolve_model_key
+from Instrumentation import instrumentation
+from StudyInference import (VIEW_CONDITIONS, aggregate_slices, decode_slice, find_series, prediction_entry,
+                            predict_slices, view_columns)
+
+def fit_temperature(logits, labels, temperatures=np.logspace(-1, 1, 81)):
+    """
+    Temperature that minimizes the negative log likelihood of held-out predictions.
+
+    Args:
+        logits (numpy.array): (..., classes) logits of one view model
+        labels (numpy.array): matching (...) class indexes, negative or NaN where unknown
+        temperatures (numpy.array): candidates, all scored at once
+
+    Returns:
+        float: best temperature, 1.0 when there are no known labels
+    """
+    logits = np.asarray(logits, dtype=np.float64).reshape(-1, np.shape(logits)[-1])
+    labels = np.asarray(labels, dtype=np.float64).reshape(-1)
+    known = ~np.isnan(labels) & (labels >= 0)
+    if not known.any():
+        return 1.0
+    logits, labels = logits[known], labels[known].astype(int)
+    scaled = logits[None] / temperatures[:, None, None]  # (temperatures, samples, classes)
+    scaled -= scaled.max(axis=2, keepdims=True)
+    log_probabilities = scaled - np.log(np.exp(scaled).sum(axis=2, keepdims=True))
+    nll = -log_probabilities[:, np.arange(len(labels)), labels].mean(axis=1)
+    return float(temperatures[nll.argmin()])
+
+def fit_calibration(store_dir, cnns=("alex", "res"), views=VIEWS, labels_path="./data/train_cleaned.csv",
+                    cache_dir="./eval_cache", **split):
+    """
+    Temperature of every (cnn, view), fitted on the slice logits of the held-out split of a slice
+    store against the labels of the condition each view model was trained on. The logits come
+    from the feature cache of Evaluation, so only the first fit runs the backbones.
+
+    Args:
+        split: passed to Evaluation.cached_features to choose the held-out slices
+
+    Returns:
+        dict: {cnn: {view: temperature}}, the format read by load_calibration
+    """
+    from Evaluation import cached_features, head_logits
+    from LabelStore import LabelStore
+
+    labels = LabelStore.load(labels_path)
+    calibration = {}
+    for cnn in cnns:
+        cnn_calibration = calibration.setdefault(resolve_model_key(cnn, "saggital1")[0], {})
+        for view in views:
+            features, study_ids, weight, bias = cached_features(store_dir, cnn, view, cache_dir=cache_dir, **split)
+            known = np.isin(study_ids, labels.study_ids)
+            logits = head_logits(features, weight, bias)[known]
+            view_labels = labels.lookup(study_ids[known], conditions=VIEW_CONDITIONS[view][:1])[:, :, 0]
+            cnn_calibration[view] = fit_temperature(logits, view_labels)
+    return calibration
+
+def save_calibration(path, calibration):
+    """Write a calibration, keeping the cnns of an existing file that were not fitted again."""
+    try:
+        with open(path) as f:
+            merged = json.load(f)
+    except FileNotFoundError:
+        merged = {}
+    for cnn, temperatures in calibration.items():
+        merged.setdefault(cnn, {}).update(temperatures)
+    save_atomic(path, lambda f: f.write(json.dumps(merged, indent=2).encode()))
+    return merged
+
+def load_calibration(path, cnn):
+    """view -> temperature of a cnn from a JSON file like {"alexnet": {"saggital1": 1.2, ...}}."""
+    with open(path) as f:
+        calibration = json.load(f)
+    cnn = resolve_model_key(cnn, "saggital1")[0]
+    return {view: float(temperature) for view, temperature in calibration.get(cnn, {}).items()}
+
+def worst_severity(distributions):
+    """
+    Distribution of the most severe finding among independent (views, levels, classes) distributions:
+    P(worst <= c) is the product over views of P(view <= c).
+    """
+    cumulative = torch.cumsum(distributions, dim=-1).prod(dim=0)
+    return torch.diff(cumulative, dim=-1, prepend=torch.zeros_like(cumulative[..., :1]))
+
+def view_worker_init(intra_op_threads):
+    """Initializer of a view worker process, the thread count only applies inside that process."""
+    torch.set_num_threads(intra_op_threads)
+
+def view_probabilities(cnn, view, backend, slices, batch_size, temperature):
+    """Calibrated softmax of the decoded slices of a view, runs in the worker process of the view."""
+    return predict_slices(registry.get(cnn, view, backend), slices, batch_size, temperature=temperature)
+
+class FusionPredictor:
+    """
+    Runs the view models of a cnn concurrently for a study.
+
+    Every view has its own worker process, started on the first prediction and kept until close,
+    where its model stays loaded. The intra-op budget is fixed here, once, by the initializer of
+    those workers: the process-wide torch.set_num_threads only ever runs inside a view worker, so
+    the threads of the calling process keep their own count. The files of a study are decoded once,
+    by a decode pool shared by all views, before the views run.
+
+    Args:
+        cnn (string): alex or res
+        views (list): views to run, all three by default
+        batch_size (int): slices per forward pass, bounds the activation memory of long series
+        temperatures (dict): view -> temperature dividing its logits before the softmax, see
+            fit_calibration and load_calibration. Views without one are not calibrated
+        backend (string): inference backend, see MODEL_BACKENDS
+        aggregate (string): how the slices of a series are combined, see aggregate_slices
+        intra_op_threads (int): torch threads of each view worker, defaults to the CPU count split
+            between the views so the concurrent forwards do not oversubscribe the CPU
+        workers (int): processes of the decode pool, None for the CPU count, 0 decodes in this process
+    """
+
+    def __init__(self, cnn="alex", views=VIEWS, batch_size=32, temperatures=None, backend="fp32", aggregate="mean",
+                 intra_op_threads=None, workers=None):
+        self.cnn = cnn
+        self.views = [resolve_model_key(cnn, view)[1] for view in views]
+        self.batch_size = batch_size
+        self.temperatures = temperatures or {}
+        self.backend = backend
+        self.aggregate = aggregate
+        self.intra_op_threads = intra_op_threads or max(1, (os.cpu_count() or 1) // len(self.views))
+        # spawn keeps CUDA and the threads of the calling process out of the workers
+        context = multiprocessing.get_context("spawn")
+        self.view_workers = {
+            view: ProcessPoolExecutor(1, context, initializer=view_worker_init, initargs=(self.intra_op_threads,))
+            for view in self.views
+        }
+        self.decode_pool = ProcessPoolExecutor(workers, context) if workers != 0 else None
+
+    def _decode(self, paths):
+        """Shared preprocessing stage: every distinct file of the study decoded once."""
+        paths = list(dict.fromkeys(paths))
+        if self.decode_pool is None:
+            return dict(zip(paths, map(decode_slice, paths)))
+        return dict(zip(paths, self.decode_pool.map(decode_slice, paths, chunksize=max(1, self.batch_size // 4))))
+
+    def predict(self, study, series_descriptions=None, timeout=None):
+        """
+        Report of a study, calibrated for the views that have a temperature.
+
+        Args:
+            study (string or dict): study directory, or view -> DICOM path or list of slice paths.
+                The same file may be given for several views, it is decoded once
+            series_descriptions (dict): optional series_id -> description when study is a directory
+            timeout (float): latency budget in seconds of the whole call, TimeoutError past it
+
+        Returns:
+            dict: {
+                'conditions': {column: {'Class', 'Confidence', 'Probabilities'}} as in predict_study,
+                'levels': {level: {'Class', 'Confidence', 'Probabilities'}} most severe finding of each level,
+                'views': views that were run,
+                'calibrated': views whose distributions were temperature scaled,
+                'seconds': {'preprocess', 'models', 'total'}
+            }
+        """
+        start = time.perf_counter()
+        deadline = start + timeout if timeout is not None else None
+        if isinstance(study, str):
+            study = find_series(study, series_descriptions)
+        inputs = {view: [paths] if isinstance(paths, str) else list(paths) for view, paths in study.items() if view in self.views}
+        if not inputs:
+            raise ValueError("no series of the study matches the views of the predictor")
+
+        with instrumentation.request("fused_study"):
+            with instrumentation.stage("preprocess"):
+                decoded = self._decode(path for paths in inputs.values() for path in paths)
+            preprocessed = time.perf_counter()
+
+            with instrumentation.stage("forward"):
+                futures = {
+                    view: self.view_workers[view].submit(
+                        view_probabilities, self.cnn, view, self.backend, np.stack([decoded[path] for path in inputs[view]]),
+                        self.batch_size, self.temperatures.get(view, 1.0),
+                    )
+                    for view in self.views if view in inputs
+                }
+                remaining = max(0.0, deadline - time.perf_counter()) if deadline is not None else None
+                _, pending = wait(futures.values(), timeout=remaining)
+                if pending:
+                    raise TimeoutError(f"study prediction exceeded {timeout} seconds")
+                distributions = {view: aggregate_slices(future.result(), self.aggregate) for view, future in futures.items()}
+        finished = time.perf_counter()
+
+        conditions = {}
+        for view, distribution in distributions.items():
+            conditions.update(view_columns(view, distribution))
+        worst = worst_severity(torch.stack(list(distributions.values())))
+        return {
+            'conditions': dict(sorted(conditions.items())),
+            'levels': {level: prediction_entry(worst[level_idx]) for level_idx, level in enumerate(Levels)},
+            'views': list(distributions),
+            'calibrated': [view for view in distributions if view in self.temperatures],
+            'seconds': {
+                'preprocess': preprocessed - start,
+                'models': finished - preprocessed,
+                'total': finished - start,
+            },
+        }
+
+    def close(self):
+        for executor in self.view_workers.values():
+            executor.shutdown()
+        if self.decode_pool is not None:
+            self.decode_pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Predict a whole study with the three view models")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    predict = commands.add_parser("predict", help="report of one study")
+    predict.add_argument("study_dir", help="study directory, one sub directory per series")
+    predict.add_argument("--cnn", default="alex", choices=["alex", "res"])
+    predict.add_argument("--batch-size", type=int, default=32, help="slices per forward pass")
+    predict.add_argument("--threads", type=int, help="torch threads of each view worker")
+    predict.add_argument("--workers", type=int, default=None, help="decoding processes, defaults to the CPU count")
+    predict.add_argument("--calibration", help="JSON temperatures per cnn and view, see calibrate")
+    predict.add_argument("--aggregate", default="mean", choices=["mean", "max"])
+    predict.add_argument("--timeout", type=float, help="latency budget in seconds")
+
+    calibrate = commands.add_parser("calibrate", help="fit the temperatures on the held-out slices of a slice store")
+    calibrate.add_argument("store_dir", help="slice store built with TrainingData.py build")
+    calibrate.add_argument("--cnn", nargs="+", default=["alex", "res"], choices=["alex", "res"])
+    calibrate.add_argument("--views", nargs="+", default=VIEWS, choices=VIEWS)
+    calibrate.add_argument("--labels", default="./data/train_cleaned.csv")
+    calibrate.add_argument("--split", help="held-out study ids of the checkpoints, see Evaluation.split_description")
+    calibrate.add_argument("--cache-dir", default="./eval_cache", help="feature cache of Evaluation")
+    calibrate.add_argument("--output", default="calibration.json")
+    args = parser.parse_args(argv)
+
+    if args.command == "calibrate":
+        calibration = fit_calibration(args.store_dir, args.cnn, args.views, args.labels, args.cache_dir, split_path=args.split)
+        print(json.dumps(save_calibration(args.output, calibration), indent=2), file=sys.stdout)
+        return
+
+    temperatures = load_calibration(args.calibration, args.cnn) if args.calibration else None
+    with FusionPredictor(args.cnn, batch_size=args.batch_size, temperatures=temperatures, aggregate=args.aggregate,
+                         intra_op_threads=args.threads, workers=args.workers) as predictor:
+        report = predictor.predict(args.study_dir, timeout=args.timeout)
+    print(json.dumps(report, indent=2), file=sys.stdout)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+'''
+Accuracy report of the int8, TorchScript and ONNX inference backends against the fp32 models.
+
+Runs every backend over the same held-out slices and reports, per backend, the accuracy against
+the labels of data/train_cleaned.csv, the agreement with the fp32 predictions, the largest
+probability difference and the time per slice. The held-out studies of the checkpoints should be
+given with --split, see Evaluation.split_description, otherwise they are sampled from every
+labelled study and the report says so under "split":
+
+    python backend_report.py /kaggle/input/.../train_images --cnn alex --split held_out.csv --output report.json
+
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+import torch
+
+from InteractiveModels import MODEL_BACKENDS, iter_batches, load_model, model_device
+from Evaluation import split_description
+from StudyInference import LEVEL_SUFFIXES, VIEW_CONDITIONS, decode_slice, find_series, slices_to_tensor
+
+def choose_studies(images_root, labels, studies, seed=42, split_path=None):
+    """
+    Studies to score and their split_description. With split_path the labelled studies of the
+    split file present under images_root, all of them unless studies is given, otherwise a sample
+    of every labelled study.
+    """
+    split = split_description(split_path, "random sample of every labelled study", seed=seed)
+    candidates = split["studies"] if split_path else labels.index
+    available = [study_id for study_id in candidates
+                 if study_id in labels.index and os.path.isdir(os.path.join(images_root, str(study_id)))]
+    if split_path and studies is None:
+        chosen = available
+    else:
+        rng = np.random.default_rng(seed)
+        size = min(studies or 50, len(available))
+        chosen = rng.choice(available, size=size, replace=False).tolist() if available else []
+    split["studies"] = len(chosen)
+    return sorted(chosen), split
+
+def held_out_slices(images_root, labels, chosen):
+    """
+    Yield (view, path, level labels) for each slice of the chosen studies.
+    Labels are the severities of the condition the view model was trained on.
+    """
+    for study_id in chosen:
+        for view, paths in find_series(os.path.join(images_root, str(study_id))).items():
+            condition = VIEW_CONDITIONS[view][0]
+            columns = [f"{condition}_{level}" for level in LEVEL_SUFFIXES]
+            level_labels = labels.loc[study_id, columns].to_numpy()
+            for path in paths:
+                yield view, path, level_labels
+
+def run_backend(cnn, view, backend, images, batch_size):
+    """Softmax outputs of a backend for a (slices, 224, 224) uint8 array and the seconds per slice."""
+    model = load_model(cnn, view, backend)
+    device = model_device(model)
+    probabilities = []
+    elapsed = 0.0
+    for batch in iter_batches(images, batch_size):
+        inputs = slices_to_tensor(batch).to(device)
+        start = time.perf_counter()
+        with torch.no_grad():
+            # Copying the logits back waits for the device, so the time covers the whole forward pass
+            outputs = model(inputs).cpu()
+        elapsed += time.perf_counter() - start
+        probabilities.append(torch.softmax(outputs, dim=2))
+    return torch.cat(probabilities).numpy(), elapsed / len(images)
+
+def report(images_root, labels_path, cnn="alex", backends=MODEL_BACKENDS, studies=None, batch_size=32, seed=42, split_path=None):
+    labels = pd.read_csv(labels_path, index_col=0).set_index("study_id")
+    chosen, split = choose_studies(images_root, labels, studies, seed, split_path)
+    by_view = {}
+    for view, path, level_labels in held_out_slices(images_root, labels, chosen):
+        by_view.setdefault(view, ([], []))
+        by_view[view][0].append(decode_slice(path))
+        by_view[view][1].append(level_labels)
+
+    results = {"split": split}
+    for view, (images, view_labels) in by_view.items():
+        view_labels = np.stack(view_labels)
+        known = ~np.isnan(view_labels.astype(float))
+        outputs = {backend: run_backend(cnn, view, backend, images, batch_size) for backend in backends}
+        reference = outputs["fp32"][0] if "fp32" in outputs else None
+        results[view] = {"slices": len(images)}
+        for backend, (probabilities, seconds) in outputs.items():
+            predicted = probabilities.argmax(axis=2)
+            entry = {
+                "accuracy": float((predicted == view_labels)[known].mean()) if known.any() else None,
+                "seconds_per_slice": seconds,
+            }
+            if reference is not None:
+                entry["agreement_with_fp32"] = float((predicted == reference.argmax(axis=2)).mean())
+                entry["max_probability_delta"] = float(np.abs(probabilities - reference).max())
+                if entry["accuracy"] is not None:
+                    reference_accuracy = float((reference.argmax(axis=2) == view_labels)[known].mean())
+                    entry["accuracy_delta"] = entry["accuracy"] - reference_accuracy
+            results[view][backend] = entry
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the inference backends against fp32 on held-out studies")
+    parser.add_argument("images_root", help="train_images directory, one folder per study")
+    parser.add_argument("--labels", default="./data/train_cleaned.csv")
+    parser.add_argument("--cnn", default="alex", choices=["alex", "res"])
+    parser.add_argument("--backends", nargs="+", default=MODEL_BACKENDS, choices=MODEL_BACKENDS)
+    parser.add_argument("--split", help="held-out study ids the checkpoints were not trained on, CSV with study_id or one per line")
+    parser.add_argument("--studies", type=int, help="number of studies sampled, every study of --split or 50 without it")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="JSON file for the report, printed when omitted")
+    args = parser.parse_args(argv)
+
+    results = report(args.images_root, args.labels, args.cnn, args.backends, args.studies, args.batch_size, args.seed, args.split)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text, file=sys.stdout)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+'''
+Command line scoring of every DICOM under a directory, without the Streamlit app.
+
+Results are written as they finish, one JSON object per line or one CSV row per file:
+
+    python batch_score.py /data/studies --cnn alex --view auto --output scores.jsonl
+    python batch_score.py /data/studies --output scores.jsonl --resume
+    python batch_score.py /data/studies --output scores.jsonl --overwrite
+
+'''
+
+import os
+import sys
+import csv
+import json
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pydicom
+import torch
+
+from InteractiveModels import VIEWS, Levels, outputs_to_predictions, registry
+from StudyInference import resize_slice, series_view, slices_to_tensor
+
+def walk_dicoms(root, skip=()):
+    """Yield the .dcm paths under root in a stable order, without listing the whole tree first."""
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories.sort()
+        for name in sorted(files):
+            if name.lower().endswith(".dcm"):
+                path = os.path.join(directory, name)
+                if path not in skip:
+                    yield path
+
+def decode_with_view(path, view):
+    """Decode a slice in a worker, taking the view from its series description when the view is auto."""
+    dataset = pydicom.dcmread(path)
+    if view == "auto":
+        view = series_view(getattr(dataset, "SeriesDescription", None))
+    return path, view, resize_slice(dataset)
+
+def read_ahead(paths, view, pool, limit):
+    """
+    Decode paths in the pool keeping at most limit files in flight, yields
+    (path, view, image) or (path, None, exception) in the walk order.
+    """
+    pending = deque()
+    paths = iter(paths)
+    while True:
+        while len(pending) < limit:
+            path = next(paths, None)
+            if path is None:
+                break
+            pending.append((path, pool.submit(decode_with_view, path, view)))
+        if not pending:
+            return
+        path, future = pending.popleft()
+        try:
+            yield future.result()
+        except Exception as error:
+            yield path, None, error
+
+def score(paths, cnn, view, pool, batch_size=32, limit=64):
+    """Yield (path, predictions) as batches finish, routing each slice to the model of its view."""
+    batches = {name: [] for name in VIEWS}
+
+    def flush(name):
+        batch = batches[name]
+        batches[name] = []
+        model = registry.get(cnn, name)
+        with torch.no_grad():
+            outputs = model(slices_to_tensor([image for _, image in batch]).to(registry.device))
+        return zip([path for path, _ in batch], outputs_to_predictions(outputs.cpu()))
+
+    for path, slice_view, image in read_ahead(paths, view, pool, limit):
+        if isinstance(image, Exception):
+            print(f"skipping {path}: {image}", file=sys.stderr)
+            continue
+        if slice_view is None:
+            print(f"skipping {path}: unknown series description", file=sys.stderr)
+            continue
+        batches[slice_view].append((path, image))
+        if len(batches[slice_view]) == batch_size:
+            for result in flush(slice_view):
+                yield slice_view, result
+    for name in VIEWS:
+        if batches[name]:
+            for result in flush(name):
+                yield name, result
+
+class JsonlWriter:
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, path, view, predictions):
+        self.f.write(json.dumps({"path": path, "view": view, "predictions": predictions}) + "\n")
+
+    @staticmethod
+    def done_paths(f):
+        return {json.loads(line)["path"] for line in f if line.strip()}
+
+class CsvWriter:
+    fields = ["path", "view"] + [f"{level} {field}" for level in Levels for field in ("Class", "Confidence")]
+
+    def __init__(self, f):
+        self.writer = csv.DictWriter(f, fieldnames=self.fields)
+        if f.tell() == 0:
+            self.writer.writeheader()
+
+    def write(self, path, view, predictions):
+        row = {"path": path, "view": view}
+        for level, result in predictions.items():
+            row[f"{level} Class"] = result["Class"]
+            row[f"{level} Confidence"] = result["Confidence"]
+        self.writer.writerow(row)
+
+    @staticmethod
+    def done_paths(f):
+        return {row["path"] for row in csv.DictReader(f)}
+
+WRITERS = {"jsonl": JsonlWriter, "csv": CsvWriter}
+
+def drop_partial_line(path, block_size=65536):
+    """
+    Truncate an output killed mid-write back to its last complete line, so the resumed run
+    neither parses nor appends onto a half written row. Returns the number of bytes dropped.
+    """
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(0, end - block_size)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            f.truncate(end)
+        return size - end
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Score every DICOM under a directory with the lumbar models")
+    parser.add_argument("root", help="directory walked recursively for .dcm files")
+    parser.add_argument("--cnn", default="alex", choices=["alex", "res"])
+    parser.add_argument("--view", default="auto", choices=["auto"] + VIEWS,
+                        help="model view, auto reads the SeriesDescription of each file")
+    parser.add_argument("--output", required=True, help="output file, .csv or .jsonl")
+    parser.add_argument("--format", choices=list(WRITERS), help="defaults to the output extension")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--read-ahead", type=int, default=64, help="maximum files decoded ahead of the model")
+    parser.add_argument("--workers", type=int, default=None, help="decoding processes, defaults to the CPU count")
+    parser.add_argument("--resume", action="store_true", help="skip files already in the output")
+    parser.add_argument("--overwrite", action="store_true", help="replace an existing output instead of failing")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    output_format = args.format or ("csv" if args.output.endswith(".csv") else "jsonl")
+    writer_class = WRITERS[output_format]
+
+    done = set()
+    if args.resume and os.path.exists(args.output):
+        dropped = drop_partial_line(args.output)
+        if dropped:
+            print(f"dropped a partial last line of {dropped} bytes from {args.output}", file=sys.stderr)
+        with open(args.output, newline="") as f:
+            done = writer_class.done_paths(f)
+    elif os.path.exists(args.output):
+        if not args.overwrite:
+            sys.exit(f"{args.output} already exists, pass --resume to continue it or --overwrite to replace it")
+        os.remove(args.output)
+
+    scored = 0
+    with open(args.output, "a", newline="") as f, ProcessPoolExecutor(max_workers=args.workers) as pool:
+        writer = writer_class(f)
+        paths = walk_dicoms(args.root, skip=done)
+        for view, (path, predictions) in score(paths, args.cnn, args.view, pool, args.batch_size, args.read_ahead):
+            writer.write(path, view, predictions)
+            scored += 1
+            if scored % args.batch_size == 0:
+                f.flush()
+    print(f"scored {scored} files, skipped {len(done)} already in {args.output}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
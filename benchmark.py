@@ -0,0 +1,337 @@
+'''
+Reproducible latency and throughput benchmark of the InteractiveModels pipeline.
+
+Synthetic DICOMs are generated with pydicom and every stage is timed on its own: decode,
+transform, forward, compute_saliency_map and render_overlays. Results are JSON:
+
+    python benchmark.py --output bench.json
+    python benchmark.py --cnn alex --batch-sizes 1 8 --threads 1 4 --output new.json --compare bench.json
+
+Models are randomly initialized with a fixed seed, the timings do not depend on the weights.
+Use --checkpoints to time the real ones from ./models instead.
+
+Cold start is measured in fresh interpreters: the time to import InteractiveModels and the
+time until the first forward of a model has run (--startup-runs, 0 skips it).
+
+'''
+
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import numpy as np
+import pydicom
+import torch
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+from InteractiveModels import (
+    compute_saliency_maps,
+    dicom_to_uint8,
+    model_class,
+    registry,
+    render_overlays,
+    transform,
+)
+from Instrumentation import process_rss_bytes
+
+STAGES = ["decode", "transform", "forward", "saliency", "overlay"]
+
+# (rows, columns, bits stored) of typical series: sagittal T1/T2 and axial T2 slices
+IMAGE_SPECS = [(384, 384, 12), (512, 512, 12), (640, 640, 16)]
+
+def make_synthetic_dicom(path, rows, columns, bits_stored=12, seed=0):
+    """Write a single frame MR DICOM with a smooth body-like blob plus noise."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:rows, 0:columns]
+    blob = np.exp(-(((y - rows / 2) / (rows / 3)) ** 2 + ((x - columns / 2) / (columns / 4)) ** 2))
+    maximum = 2 ** bits_stored - 1
+    pixels = np.clip(blob * maximum * 0.8 + rng.normal(0, maximum * 0.05, (rows, columns)), 0, maximum)
+    bits_allocated = 8 if bits_stored <= 8 else 16
+    pixels = pixels.astype(np.uint8 if bits_allocated == 8 else np.uint16)
+
+    meta = FileMetaDataset()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    meta.MediaStorageSOPClassUID = MRImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    dataset = Dataset()
+    dataset.file_meta = meta
+    dataset.SOPClassUID = MRImageStorage
+    dataset.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    dataset.Modality = "MR"
+    dataset.SeriesDescription = "Sagittal T1"
+    dataset.Rows, dataset.Columns = rows, columns
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = "MONOCHROME2"
+    dataset.BitsAllocated = bits_allocated
+    dataset.BitsStored = bits_stored
+    dataset.HighBit = bits_stored - 1
+    dataset.PixelRepresentation = 0
+    dataset.PixelData = pixels.tobytes()
+    dataset.save_as(path, enforce_file_format=True)
+    return path
+
+def benchmark_model(cnn, checkpoints=False, seed=0):
+    if checkpoints:
+        return registry.get(cnn, "saggital1")
+    torch.manual_seed(seed)
+    return model_class(cnn)().to(registry.device).eval()
+
+def percentiles(samples):
+    samples = np.asarray(samples) * 1000.0
+    return {
+        "p50_ms": float(np.percentile(samples, 50)),
+        "p95_ms": float(np.percentile(samples, 95)),
+        "p99_ms": float(np.percentile(samples, 99)),
+        "mean_ms": float(samples.mean()),
+    }
+
+def peak_rss_mb():
+    """High-water mark of the whole process lifetime, it never goes down between cases."""
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+class RssSampler:
+    """
+    Samples the resident memory from a background thread while a case runs, so each case gets
+    its own peak instead of the process-wide ru_maxrss. The peaks are None where
+    process_rss_bytes can not read the RSS.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start_bytes = None
+        self.peak_bytes = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        rss = process_rss_bytes()
+        if rss is not None:
+            self.peak_bytes = rss if self.peak_bytes is None else max(self.peak_bytes, rss)
+        return rss
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self.start_bytes = self._sample()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def peak_mb(self):
+        return self.peak_bytes / (1024 * 1024) if self.peak_bytes is not None else None
+
+    def growth_mb(self):
+        """Peak above the RSS the case started with."""
+        if self.peak_bytes is None or self.start_bytes is None:
+            return None
+        return (self.peak_bytes - self.start_bytes) / (1024 * 1024)
+
+# Run in a fresh interpreter with the cnn as argument, prints the startup times as JSON
+STARTUP_SCRIPT = """
+import sys, json, time
+start = time.perf_counter()
+import InteractiveModels
+imported = time.perf_counter()
+loaded = [name for name in ("torch", "torchvision", "pydicom", "matplotlib") if name in sys.modules]
+import numpy as np
+model = InteractiveModels.model_class(sys.argv[1])().eval()
+with InteractiveModels.torch.no_grad():
+    model(InteractiveModels.preprocess([np.zeros((256, 256), dtype=np.uint8)]))
+print(json.dumps({"import": imported - start, "first_forward": time.perf_counter() - start, "loaded": loaded}))
+"""
+
+def measure_startup(cnn, runs):
+    """Import and first forward times of runs fresh interpreters, with the heavy modules the import loaded."""
+    samples = {"import": [], "first_forward": []}
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT, cnn],
+            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True,
+        )
+        record = json.loads(output.stdout.splitlines()[-1])
+        for name in samples:
+            samples[name].append(record[name])
+    return {
+        "cnn": cnn,
+        "stages": {name: percentiles(values) for name, values in samples.items()},
+        "modules_loaded_by_import": record["loaded"],
+    }
+
+def run_case(model, paths, batch_size, iterations, warmup=2):
+    """Time each stage over iterations batches of the given files, in seconds per batch."""
+    device = registry.device
+    timings = {stage: [] for stage in STAGES}
+    total_images = 0
+    total_time = 0.0
+    for iteration in range(warmup + iterations):
+        batch_paths = [paths[(iteration * batch_size + i) % len(paths)] for i in range(batch_size)]
+        times = {}
+
+        start = time.perf_counter()
+        raws = [dicom_to_uint8(pydicom.dcmread(path)) for path in batch_paths]
+        times["decode"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        images = torch.stack([transform(raw) for raw in raws]).to(device)
+        times["transform"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with torch.no_grad():
+            model(images)
+        times["forward"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        saliency_maps = compute_saliency_maps(model, images, device)
+        times["saliency"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        render_overlays(saliency_maps, raws)
+        times["overlay"] = time.perf_counter() - start
+
+        if iteration >= warmup:
+            for stage in STAGES:
+                timings[stage].append(times[stage])
+            total_images += batch_size
+            total_time += sum(times.values())
+    return timings, total_images / total_time
+
+def run(cnns, batch_sizes, threads, image_specs, iterations, checkpoints=False, seed=0, startup_runs=5):
+    results = []
+    startup = [measure_startup(cnn, startup_runs) for cnn in cnns] if startup_runs else []
+    for record in startup:
+        print(f"{record['cnn']} startup: import {record['stages']['import']['p50_ms']:.0f} ms, "
+              f"first forward {record['stages']['first_forward']['p50_ms']:.0f} ms", file=sys.stderr)
+    with tempfile.TemporaryDirectory() as directory:
+        files = {}
+        for rows, columns, bits in image_specs:
+            files[(rows, columns, bits)] = [
+                make_synthetic_dicom(os.path.join(directory, f"{rows}x{columns}_{bits}_{i}.dcm"), rows, columns, bits, seed + i)
+                for i in range(8)
+            ]
+        for cnn in cnns:
+            model = benchmark_model(cnn, checkpoints, seed)
+            for thread_count in threads:
+                torch.set_num_threads(thread_count)
+                for (rows, columns, bits), paths in files.items():
+                    for batch_size in batch_sizes:
+                        with RssSampler() as rss:
+                            timings, images_per_sec = run_case(model, paths, batch_size, iterations)
+                        results.append({
+                            "cnn": cnn,
+                            "batch_size": batch_size,
+                            "threads": thread_count,
+                            "image": f"{rows}x{columns}x{bits}bit",
+                            "stages": {stage: percentiles(samples) for stage, samples in timings.items()},
+                            "images_per_sec": images_per_sec,
+                            "peak_rss_mb": rss.peak_mb(),
+                            "rss_growth_mb": rss.growth_mb(),
+                        })
+                        print(f"{cnn} {rows}x{columns}x{bits}bit batch {batch_size} threads {thread_count}: "
+                              f"{images_per_sec:.1f} images/s", file=sys.stderr)
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "device": str(registry.device),
+            "iterations": iterations,
+            "seed": seed,
+            "checkpoints": checkpoints,
+            "process_peak_rss_mb": peak_rss_mb(),
+        },
+        "results": results,
+        "startup": startup,
+    }
+
+def case_key(result):
+    return (result["cnn"], result["batch_size"], result["threads"], result["image"])
+
+def compare(current, baseline, threshold=0.1):
+    """
+    Regressions of current against baseline: a stage whose p50 grew, or a throughput that
+    dropped, by more than threshold (relative). Cases missing from the baseline are skipped.
+    """
+    baseline_cases = {case_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        reference = baseline_cases.get(case_key(result))
+        if reference is None:
+            continue
+        for stage, stats in result["stages"].items():
+            before = reference["stages"].get(stage, {}).get("p50_ms")
+            if before and stats["p50_ms"] > before * (1 + threshold):
+                regressions.append({"case": case_key(result), "metric": f"{stage}.p50_ms",
+                                    "baseline": before, "current": stats["p50_ms"]})
+        before = reference["images_per_sec"]
+        if result["images_per_sec"] < before * (1 - threshold):
+            regressions.append({"case": case_key(result), "metric": "images_per_sec",
+                                "baseline": before, "current": result["images_per_sec"]})
+    baseline_startup = {record["cnn"]: record for record in baseline.get("startup", [])}
+    for record in current.get("startup", []):
+        reference = baseline_startup.get(record["cnn"])
+        if reference is None:
+            continue
+        for stage, stats in record["stages"].items():
+            before = reference["stages"].get(stage, {}).get("p50_ms")
+            if before and stats["p50_ms"] > before * (1 + threshold):
+                regressions.append({"case": ("startup", record["cnn"]), "metric": f"{stage}.p50_ms",
+                                    "baseline": before, "current": stats["p50_ms"]})
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the InteractiveModels pipeline")
+    parser.add_argument("--cnn", nargs="+", default=["alex", "res"], choices=["alex", "res"])
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 4, 16])
+    parser.add_argument("--threads", nargs="+", type=int, default=[1, os.cpu_count() or 1])
+    parser.add_argument("--images", nargs="+", default=[f"{r}x{c}x{b}" for r, c, b in IMAGE_SPECS],
+                        help="synthetic image specs as ROWSxCOLUMNSxBITS")
+    parser.add_argument("--iterations", type=int, default=20, help="timed batches per case")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--checkpoints", action="store_true", help="time the ./models checkpoints")
+    parser.add_argument("--startup-runs", type=int, default=5, help="fresh interpreters timed for the cold start")
+    parser.add_argument("--output", help="JSON results file, printed when omitted")
+    parser.add_argument("--compare", metavar="BASELINE", help="flag regressions against a saved results file")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change counted as a regression")
+    args = parser.parse_args(argv)
+
+    image_specs = [tuple(int(value) for value in spec.split("x")) for spec in args.images]
+    results = run(args.cnn, args.batch_sizes, sorted(set(args.threads)), image_specs, args.iterations,
+                  args.checkpoints, args.seed, args.startup_runs)
+
+    if args.compare:
+        with open(args.compare) as f:
+            results["regressions"] = compare(results, json.load(f), args.threshold)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if results.get("regressions"):
+        for regression in results["regressions"]:
+            print(f"regression {regression['case']} {regression['metric']}: "
+                  f"{regression['baseline']:.3f} -> {regression['current']:.3f}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,100 @@
 import os
-import torch
-import pydicom
 import tempfile
 import numpy as np
 from PIL import Image
 import streamlit as st
 from datetime import datetime
+from urllib.parse import quote
 from InteractiveModels import predict_image
 from InteractiveModels import predict_diagnosis # No entiendo porque no la encuentra 
-from pydicom.pixel_data_handlers.util import apply_modality_lut
 from InteractiveModels import process_image
+from InteractiveModels import dicom_cache, content_hash, load_model, registry, warm_up
+from Instrumentation import instrumentation, RingBufferSink
+from PatientStore import PatientStore
+from RenderCache import Renderer, overlay_thumbnail, save_overlay, thumbnail
+
+# Si INFERENCE_SERVER apunta al servicio de inferencia (socket o host:puerto) la app solo es un cliente
+if os.environ.get("INFERENCE_SERVER"):
+    from InferenceClient import InferenceClient
+    if "inference_client" not in st.session_state:
+        st.session_state["inference_client"] = InferenceClient(os.environ["INFERENCE_SERVER"])
+    process_image = st.session_state["inference_client"].process_image
+
+# Modelos cargados en un hilo de fondo al arrancar mientras la app ya responde,
+# p. ej. WARMUP_MODELS="alex:saggital1,res:axial" o WARMUP_MODELS=all
+@st.cache_resource
+def precargar_modelos(modelos):
+    llaves = None if modelos == "all" else [tuple(modelo.split(":", 1)) for modelo in modelos.split(",")]
+    return warm_up(llaves)
+
+if os.environ.get("WARMUP_MODELS") and "inference_client" not in st.session_state:
+    precargar_modelos(os.environ["WARMUP_MODELS"])
+
+# Límites de los caches de resultados, en entradas y segundos
+CACHE_MAX_ENTRADAS = int(os.environ.get("CACHE_MAX_ENTRADAS", 64))
+CACHE_TTL = int(os.environ.get("CACHE_TTL", 3600))
+
+# Modelos compartidos entre sesiones y reruns
+@st.cache_resource
+def obtener_modelo(cnn, vista):
+    return load_model(cnn, vista)
+
+# Predicciones y mapas de saliencia por (hash del archivo, cnn, vista), la ruta no forma parte de la llave
+@st.cache_data(max_entries=CACHE_MAX_ENTRADAS, ttl=CACHE_TTL, show_spinner=False)
+def diagnostico_cacheado(hash_imagen, cnn, vista, _ruta_imagen):
+    return process_image(cnn, vista, _ruta_imagen)
+
+# Cascada: AlexNet responde primero y solo las imágenes con algún nivel bajo CASCADE_THRESHOLD pasan a ResNet
+# (CASCADE_MODE=escalate) o al promedio de ambos (CASCADE_MODE=ensemble)
+@st.cache_resource
+def obtener_cascada(vista):
+    from ModelCascade import ModelCascade
+    return ModelCascade(
+        vista,
+        threshold=float(os.environ.get("CASCADE_THRESHOLD", 0.6)),
+        mode=os.environ.get("CASCADE_MODE", "escalate"),
+    )
+
+@st.cache_data(max_entries=CACHE_MAX_ENTRADAS, ttl=CACHE_TTL, show_spinner=False)
+def prediccion_cacheada(hash_imagen, cnn, vista, _ruta_imagen):
+    if cnn == "cascada":
+        return obtener_cascada(vista).predict_image(_ruta_imagen)[0]
+    if "inference_client" in st.session_state:
+        return st.session_state["inference_client"].predict(_ruta_imagen, cnn, vista)[0]
+    return predict_image(obtener_modelo(cnn, vista), _ruta_imagen, registry.device)
+
+def hash_imagen(ruta_imagen):
+    return dicom_cache.key(ruta_imagen)[0]
+
+# Índice de pacientes, imágenes y predicciones; las carpetas de ./Images que no estén se agregan al iniciar
+@st.cache_resource
+def obtener_store():
+    store = PatientStore()
+    store.ingest()
+    return store
+
+# Número de pacientes o imágenes por página
+TAMANO_PAGINA = 10
+
+def seleccionar_pagina(total, llave):
+    paginas = max(1, (total + TAMANO_PAGINA - 1) // TAMANO_PAGINA)
+    pagina = st.number_input("Página", min_value=1, max_value=paginas, value=1, key=llave) if paginas > 1 else 1
+    return (pagina - 1) * TAMANO_PAGINA
+
+# Miniaturas y overlays generados al subir la imagen, en hilos de fondo (RENDER_WORKERS=0 los genera en el momento)
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", 2))
+
+@st.cache_resource
+def obtener_renderer():
+    return Renderer(RENDER_WORKERS) if RENDER_WORKERS > 0 else None
+
+# Diagnóstico de una imagen subida, guarda la predicción y su overlay en el índice
+def diagnosticar_subida(store, id_subida, cnn="alex", vista="saggital1"):
+    def diagnosticar(ruta_imagen):
+        predictions, overlayed_image = process_image(cnn, vista, ruta_imagen)
+        ruta_overlay, _ = save_overlay(ruta_imagen, cnn, vista, overlayed_image)
+        store.save_prediction(id_subida, cnn, vista, predictions, ruta_overlay)
+    return diagnosticar
 
 # Configuración de la sesión para la navegación
 if "page" not in st.session_state:
@@ -108,11 +193,8 @@ st.markdown("""
 
 # convertir DICOM a imagen
 def dicom_to_image(path):
-    ds = pydicom.dcmread(path)
-    image = apply_modality_lut(ds.pixel_array, ds)
-    image = (image - image.min()) / (image.max() - image.min()) * 255.0
-    image = image.astype(np.uint8)
-    return Image.fromarray(image)
+    # La imagen decodificada se comparte con la predicción por medio del cache
+    return Image.fromarray(dicom_cache.display(path))
 
 # Función de predicción 
 def predict(image_path, model_type, view_type):
@@ -131,6 +213,7 @@ def registrar_paciente():
             st.warning("El paciente ya está registrado.")
         else:
             os.makedirs(ruta_paciente, exist_ok=True)
+            obtener_store().add_patient(nombre_paciente, ruta_paciente)
             st.success(f"Paciente '{nombre_paciente}' registrado exitosamente.")
             st.session_state["nombre_paciente"] = nombre_paciente
 
@@ -141,7 +224,7 @@ def diagnostico_lumbar():
     nombre_paciente = st.text_input("Nombre del paciente:", "", placeholder="Nombre del paciente")
     imagen_diagnostico = st.file_uploader("Seleccionar imagen del diagnóstico", type=["dcm"])
 
-    model_type = st.selectbox("Seleccionar modelo", ["alexnet", "resnet"])
+    model_type = st.selectbox("Seleccionar modelo", ["alexnet", "resnet", "cascada"])
     view_type = st.selectbox("Seleccionar vista", ["saggital1", "axial", "saggital2"])
 
     if nombre_paciente and imagen_diagnostico:
@@ -149,28 +232,47 @@ def diagnostico_lumbar():
         ruta_paciente = f"./Images/{nombre_paciente.replace(' ', '_')}"
         os.makedirs(ruta_paciente, exist_ok=True)
 
-        # Guardar imagen con fecha y hora actual
-        fecha_actual = datetime.now().strftime("%d-%m-%y_%H-%M-%S")
-        ruta_imagen = f"{ruta_paciente}/{fecha_actual}.dcm"
-        with open(ruta_imagen, "wb") as f:
-            f.write(imagen_diagnostico.getbuffer())
+        # Guardar imagen con fecha y hora actual, solo la primera vez que se sube en la sesión
+        contenido = imagen_diagnostico.getbuffer()
+        subidas = st.session_state.setdefault("subidas", {})
+        llave = (ruta_paciente, content_hash(contenido))
+        nueva = llave not in subidas
+        if nueva:
+            fecha_actual = datetime.now().strftime("%d-%m-%y_%H-%M-%S")
+            ruta_imagen = f"{ruta_paciente}/{fecha_actual}.dcm"
+            with open(ruta_imagen, "wb") as f:
+                f.write(contenido)
+            subidas[llave] = ruta_imagen
+        ruta_imagen = subidas[llave]
+        store = obtener_store()
+        store.add_patient(nombre_paciente, ruta_paciente)
+        id_subida = store.add_upload(nombre_paciente, ruta_imagen, content_hash=llave[1])
         st.success(f"Imagen guardada en {ruta_imagen}")
         
         # Guardar la ruta de la última imagen en session_state
         st.session_state["ultima_imagen"] = ruta_imagen
 
-        # Mostrar la imagen DICOM en tamaño reducido
-        image = dicom_to_image(ruta_imagen)
-        st.image(image, caption="Imagen DICOM", width=300)
+        # Mostrar la imagen DICOM en tamaño reducido, la miniatura queda guardada para la historia
+        st.image(thumbnail(ruta_imagen), caption="Imagen DICOM", width=300)
+
+        # El mapa de saliencia de la historia se genera en segundo plano
+        if nueva and obtener_renderer() is not None:
+            obtener_renderer().submit(ruta_imagen, diagnosticar_subida(store, id_subida))
 
         # Realizar la predicción
         st.write("Realizando predicción...")
-        output = predict_image(ruta_imagen, model_type, view_type)
+        output = prediccion_cacheada(llave[1], model_type, view_type, ruta_imagen)
+        if store.prediction(id_subida, model_type, view_type) is None:
+            store.save_prediction(id_subida, model_type, view_type, output)
 
         # Guardar el resultado de la predicción en session_state
         st.session_state["output"] = output
         st.write("Resultados de la predicción:")
         st.write(f"Predicción del modelo para {view_type}: {output}")
+        if model_type == "cascada":
+            estadisticas = obtener_cascada(view_type).stats()
+            st.caption(f"Imágenes escaladas a ResNet: {estadisticas['escalations']} de {estadisticas['images']} "
+                       f"({estadisticas['escalation_rate']:.0%})")
 
     # Botón para ir a la página de resultados
     if st.button("Enviar a diagnóstico"):
@@ -185,10 +287,21 @@ def pagina_resultados():
         
         # Procesar la imagen y obtener predicciones y mapa de saliencia
         # Especifica aquí el modelo CNN y tipo, como ejemplo: "alex" y "saggital1"
-        predictions, overlayed_image = process_image("alex", "saggital1", ultima_imagen)
+        store = obtener_store()
+        subida = store.upload(ultima_imagen)
+        guardada = store.prediction(subida["id"], "alex", "saggital1") if subida is not None else None
+        if guardada is not None and guardada["saliency_path"] and os.path.exists(guardada["saliency_path"]):
+            # Ya calculado al subir la imagen o en una visita anterior
+            predictions, overlayed_image = guardada["predictions"], guardada["saliency_path"]
+        else:
+            predictions, overlayed_image = diagnostico_cacheado(hash_imagen(ultima_imagen), "alex", "saggital1", ultima_imagen)
+            # Guardar la predicción y el mapa de saliencia en el índice una sola vez
+            if subida is not None:
+                ruta_overlay, _ = save_overlay(ultima_imagen, "alex", "saggital1", overlayed_image)
+                store.save_prediction(subida["id"], "alex", "saggital1", predictions, ruta_overlay)
 
         # Mostrar la última imagen cargada con el mapa de saliencia
-        st.image(overlayed_image, caption="Último diagnóstico cargado con Saliency Map", width=300)
+        st.image(overlayed_image, caption="Último diagnóstico cargado con Saliency Map", width=300, clamp=True)
 
         # Mostrar el resultado de la predicción por cada nivel
         if predictions:
@@ -204,19 +317,42 @@ def pagina_resultados():
     else:
         st.warning("No hay una imagen cargada recientemente. Por favor, suba una imagen en la página de diagnóstico.")
 
+    mostrar_instrumentacion()
+
+# Tiempos por etapa de las últimas predicciones, solo con INSTRUMENTATION=ring
+def mostrar_instrumentacion():
+    if not (instrumentation.enabled and isinstance(instrumentation.sink, RingBufferSink)):
+        return
+    with st.expander("Tiempos de las últimas predicciones"):
+        cantidad = st.number_input("Predicciones", min_value=1, max_value=100, value=5)
+        for request in instrumentation.sink.requests(int(cantidad)):
+            st.markdown(f"**{request['name']}** #{request['request']}")
+            st.table([
+                {
+                    "Etapa": stage["stage"],
+                    "Tiempo (ms)": round(stage["wall"] * 1000, 2),
+                    "CPU (ms)": round(stage["cpu"] * 1000, 2),
+                    "Memoria (MB)": round(stage["memory_delta"] / 2 ** 20, 2) if stage["memory_delta"] is not None else None,
+                }
+                for stage in request["stages"]
+            ])
+
 # Página de Pacientes Registrados
 def pagina_pacientes():
     st.markdown("<div class='centered-title'>Pacientes Registrados</div>", unsafe_allow_html=True)
-    pacientes = os.listdir("./Images")
+    store = obtener_store()
+    inicio = seleccionar_pagina(store.count_patients(), "pagina_pacientes")
+    pacientes = store.patients(offset=inicio, limit=TAMANO_PAGINA)
     
     if pacientes:
         for paciente in pacientes:
+            carpeta = quote(os.path.basename(paciente["folder"]))
             st.markdown(f"""
             <div class="card">
-                <a href="?page=historia_paciente&paciente={paciente}" target="_self">
+                <a href="?page=historia_paciente&paciente={carpeta}" target="_self">
                     <img src="https://img.icons8.com/ios-filled/50/000000/user.png" alt="Imagen de perfil">
                     <div class="container">
-                        <h4><b>{paciente.replace('_', ' ')}</b></h4>
+                        <h4><b>{paciente["name"]}</b></h4>
                     </div>
                 </a>
             </div>
@@ -226,12 +362,30 @@ def pagina_pacientes():
 
 # Página de Historia del Paciente
 def historia_paciente(paciente):
-    st.markdown(f"<div class='centered-title'>Historia de {paciente.replace('_', ' ')}</div>", unsafe_allow_html=True)
-    imagenes = os.listdir(f"./Images/{paciente}")
+    store = obtener_store()
+    # El enlace lleva la carpeta del paciente, el nombre no siempre se puede recuperar de ella
+    fila = store.patient_by_folder(paciente)
+    if fila is None:
+        st.warning("El paciente no está registrado.")
+        return
+    st.markdown(f"<div class='centered-title'>Historia de {fila['name']}</div>", unsafe_allow_html=True)
+    inicio = seleccionar_pagina(store.count_uploads(fila["id"]), "pagina_historia")
+    subidas = store.uploads(fila["id"], offset=inicio, limit=TAMANO_PAGINA)
     
-    if imagenes:
-        for imagen in imagenes:
-            st.image(f"./Images/{paciente}/{imagen}", caption=imagen, use_column_width=True)
+    if subidas:
+        for subida in subidas:
+            st.image(thumbnail(subida["path"]), caption=os.path.basename(subida["path"]))
+            # La imagen completa solo se decodifica si se pide
+            if st.checkbox("Ver imagen completa", key=f"completa_{subida['id']}"):
+                st.image(dicom_to_image(subida["path"]), caption=os.path.basename(subida["path"]), use_column_width=True)
+            # Predicciones guardadas, sin volver a correr el modelo
+            for prediccion in subida["predictions"]:
+                miniatura = overlay_thumbnail(subida["path"], prediccion["cnn"], prediccion["view"])
+                if miniatura is not None:
+                    st.image(miniatura, caption=f"Saliency Map {prediccion['cnn']} {prediccion['view']}")
+                st.write(f"Predicción {prediccion['cnn']} para {prediccion['view']}:")
+                for level, result in prediccion["predictions"].items():
+                    st.write(f"{level}: **{result['Class']}** (Confianza: {result['Confidence']:.2f})")
     else:
         st.warning("No hay imágenes para este paciente.")
 